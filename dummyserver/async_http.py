@@ -0,0 +1,188 @@
+#pylint:disable=missing-docstring,invalid-name
+"""HTTP/1.1 server on asyncio for BaseHTTPRequestHandler subclasses
+
+Connections are handled by the event loop instead of one thread each.
+Request heads and bodies are read asynchronously and spooled into a file
+object, the handler runs in a bounded thread pool with that as its rfile and
+another spooled file as wfile. Afterwards, Content-Length and Connection
+headers are fixed up so that the connection can be kept alive, no matter
+whether the handler set them.
+"""
+
+import asyncio
+import concurrent.futures
+import tempfile
+
+import metrics
+
+MAX_CONNECTIONS = 1000
+KEEP_ALIVE_TIMEOUT = 15 # seconds an idle connection is kept open
+HANDLER_WORKERS = 16
+MAX_HEAD_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024 # larger bodies are spooled to disk
+CHUNK_SIZE = 64 * 1024
+
+_BODYLESS_STATUS_CODES = (204, 304)
+
+class _BadRequest(Exception):
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+def parse_head(head):
+    """Returns the lower-cased header names and values of a request head"""
+    headers = {}
+    for line in head.split(b"\r\n")[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower().decode("latin-1")] = value.strip().decode("latin-1")
+    return headers
+
+def run_handler(handler_class, rfile, wfile, client_address):
+    handler = handler_class.__new__(handler_class)
+    handler.rfile = rfile
+    handler.wfile = wfile
+    handler.client_address = client_address
+    handler.server = None
+    handler.connection = None # no socket, disables sendfile()
+    handler.protocol_version = "HTTP/1.1"
+    handler.close_connection = True
+    # "100 Continue" was sent before the body was read
+    handler.handle_expect_100 = lambda: True
+    handler.handle_one_request()
+    return handler.close_connection
+
+def fix_response_head(head, body_length, keep_alive):
+    lines = head.split(b"\r\n")
+    status_code = int(lines[0].split(b" ")[1])
+    fixed = [lines[0]]
+    has_content_length = False
+    for line in lines[1:]:
+        name = line.partition(b":")[0].strip().lower()
+        if name == b"connection":
+            continue
+        if name == b"content-length":
+            has_content_length = True
+        fixed.append(line)
+    if not has_content_length and status_code not in _BODYLESS_STATUS_CODES and status_code >= 200:
+        fixed.append("Content-Length: {}".format(body_length).encode())
+    fixed.append(b"Connection: keep-alive" if keep_alive else b"Connection: close")
+    return b"\r\n".join(fixed) + b"\r\n\r\n"
+
+async def read_request(reader, writer):
+    """Returns the spooled request or None if the client closed the connection"""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_TIMEOUT)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        return None
+    except asyncio.LimitOverrunError:
+        raise _BadRequest(431, "Request Header Fields Too Large")
+
+    headers = parse_head(head)
+    if "transfer-encoding" in headers:
+        raise _BadRequest(411, "Length Required")
+    try:
+        content_length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise _BadRequest(400, "Bad Request")
+
+    if headers.get("expect", "").lower() == "100-continue":
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+    request = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    request.write(head)
+    remaining = content_length
+    while remaining > 0:
+        chunk = await reader.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            request.close()
+            return None
+        request.write(chunk)
+        remaining -= len(chunk)
+    request.seek(0)
+    return request
+
+async def write_response(writer, response, keep_alive):
+    response.seek(0)
+    data = response.read(MAX_HEAD_SIZE)
+    head_end = data.find(b"\r\n\r\n")
+    response.seek(0, 2)
+    body_length = response.tell() - head_end - 4
+    response.seek(head_end + 4)
+
+    writer.write(fix_response_head(data[:head_end], body_length, keep_alive))
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        writer.write(chunk)
+        await writer.drain()
+    await writer.drain()
+
+class HttpServer:
+    def __init__(self, handler_class, max_connections, workers):
+        self.handler_class = handler_class
+        self.max_connections = max_connections
+        self.active_connections = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        if self.active_connections >= self.max_connections:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+
+        self.active_connections += 1
+        metrics.HTTP_CONNECTIONS.inc()
+        try:
+            await self.serve_requests(client_address, reader, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self.active_connections -= 1
+            metrics.HTTP_CONNECTIONS.dec()
+            writer.close()
+
+    async def serve_requests(self, client_address, reader, writer):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                request = await read_request(reader, writer)
+            except _BadRequest as e:
+                writer.write("HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".format(
+                    e.status, e.reason).encode())
+                return
+            if request is None:
+                return
+
+            with request, tempfile.SpooledTemporaryFile(SPOOL_SIZE) as response:
+                close_connection = await loop.run_in_executor(
+                    self.executor, run_handler, self.handler_class, request, response, client_address)
+                if response.tell() == 0:
+                    return
+                await write_response(writer, response, not close_connection)
+            if close_connection:
+                return
+
+async def serve(handler_class, host, port, reuse_port=False):
+    """Starts serving on the running event loop and returns the asyncio server"""
+    http_server = HttpServer(handler_class, MAX_CONNECTIONS, HANDLER_WORKERS)
+    return await asyncio.start_server(
+        http_server.handle_connection, host, port, limit=MAX_HEAD_SIZE, reuse_port=reuse_port)
+
+def add_arguments(parser):
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="concurrent HTTP connections in asyncio mode")
+    parser.add_argument("--http-workers", type=int, default=HANDLER_WORKERS,
+                        help="threads running HTTP request handlers in asyncio mode")
+    parser.add_argument("--keep-alive-timeout", type=float, default=KEEP_ALIVE_TIMEOUT,
+                        help="seconds idle HTTP connections are kept open in asyncio mode")
+
+def configure(args):
+    global MAX_CONNECTIONS, HANDLER_WORKERS, KEEP_ALIVE_TIMEOUT
+    MAX_CONNECTIONS = args.max_connections
+    HANDLER_WORKERS = args.http_workers
+    KEEP_ALIVE_TIMEOUT = args.keep_alive_timeout
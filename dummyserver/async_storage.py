@@ -0,0 +1,54 @@
+#pylint:disable=missing-docstring,invalid-name
+import asyncio
+import concurrent.futures
+import functools
+
+import storage
+
+# Asynchronous facade of the storage module for the websocket server. Disk
+# access runs in worker threads so that the event loop keeps serving other
+# connections while files are read or written. Reads use a small pool, writes
+# go to a single writer thread which keeps them in submission order.
+
+READ_WORKERS = 4
+
+_READ_EXECUTOR = None
+_WRITE_EXECUTOR = None
+
+def start(read_workers=READ_WORKERS):
+    global _READ_EXECUTOR, _WRITE_EXECUTOR
+    _READ_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+        max_workers=read_workers, thread_name_prefix="storage-read")
+    _WRITE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="storage-write")
+
+def _run_in(executor_name, func):
+    @functools.wraps(func)
+    async def wrapper(*args):
+        if _READ_EXECUTOR is None:
+            start()
+        executor = _READ_EXECUTOR if executor_name == "read" else _WRITE_EXECUTOR
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args))
+    return wrapper
+
+get_conversation = _run_in("read", storage.get_conversation)
+get_conversation_id_by_key_id = _run_in("read", storage.get_conversation_id_by_key_id)
+get_conversation_member_ids = _run_in("read", storage.get_conversation_member_ids)
+get_conversation_permission = _run_in("read", storage.get_conversation_permission)
+get_conversation_permissions = _run_in("read", storage.get_conversation_permissions)
+get_device = _run_in("read", storage.get_device)
+get_devices = _run_in("read", storage.get_devices)
+get_user = _run_in("read", storage.get_user)
+get_users = _run_in("read", storage.get_users)
+sync_changes = _run_in("read", storage.sync_changes)
+
+_append_message = _run_in("write", storage.append_message)
+reserve_blob_ids = _run_in("write", storage.reserve_blob_ids)
+update_conversation_participants = _run_in("write", storage.update_conversation_participants)
+
+async def append_message(new_message, conversation_id):
+    if storage.BATCH_WINDOW:
+        # the batcher has its own writer thread
+        return await asyncio.wrap_future(storage.submit_message(new_message, conversation_id))
+    return await _append_message(new_message, conversation_id)
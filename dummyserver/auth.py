@@ -0,0 +1,107 @@
+#pylint:disable=missing-docstring,invalid-name
+import collections
+import re
+import threading
+import time
+
+import metrics
+import storage
+
+# Authentication of the KULLO_V1 Authorization header of REST requests.
+#
+# Verified identities are kept in a bounded LRU session cache keyed by the
+# raw header, which contains the device ID and the credentials. A hit skips
+# parsing and verification. It still reads the device, which is a cached
+# document or a primary key lookup, and drops the session if the device
+# changed since it was verified, e.g. because its state is no longer active.
+# Sessions expire after SESSION_TTL so that credentials are checked again
+# from time to time.
+
+SCHEME = "KULLO_V1"
+PARAMS_MATCHER = re.compile(r'(\w+)= ?"([^"]+)"')
+SESSION_CACHE_SIZE = 10000
+SESSION_TTL = 300.0 # seconds
+
+Session = collections.namedtuple("Session", ["user_id", "device", "expires"])
+
+_SESSIONS = collections.OrderedDict() # Authorization header -> Session
+_SESSIONS_LOCK = threading.Lock()
+
+def parse_params(authorization_header):
+    """Returns the parameters of an Authorization header as dict"""
+    authorization_header = authorization_header.replace(SCHEME, "").strip()
+    return dict(PARAMS_MATCHER.findall(authorization_header))
+
+def verify(params, device):
+    """Returns True if the credentials in `params` are valid for `device`"""
+    # TODO: use device's pubkey to verify signature
+    # TODO: check loginKey
+    return device.get("state") == "active"
+
+def authenticate(authorization_header):
+    """Returns the ID of the user authenticated by the header or None"""
+    if not authorization_header:
+        return None
+    start = time.perf_counter()
+    now = time.monotonic()
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(authorization_header)
+        if session is not None:
+            _SESSIONS.move_to_end(authorization_header)
+    if session is not None and session.expires > now:
+        try:
+            device = storage.get_device(session.device["id"])
+        except KeyError:
+            device = None
+        if device == session.device:
+            metrics.AUTH_SESSION_LOOKUPS.inc(labels=("hit",))
+            metrics.AUTH_SECONDS.observe(time.perf_counter() - start, ("hit",))
+            return session.user_id
+        result = "invalidated"
+    else:
+        result = "expired" if session is not None else "miss"
+    metrics.AUTH_SESSION_LOOKUPS.inc(labels=(result,))
+
+    user_id = None
+    params = parse_params(authorization_header)
+    if "deviceId" in params:
+        try:
+            device = storage.get_device(params["deviceId"])
+        except KeyError:
+            device = None
+        if device is not None and verify(params, device):
+            user_id = device["ownerId"]
+    with _SESSIONS_LOCK:
+        if user_id is None:
+            _SESSIONS.pop(authorization_header, None)
+        else:
+            _SESSIONS[authorization_header] = Session(user_id, device, now + SESSION_TTL)
+            _SESSIONS.move_to_end(authorization_header)
+            while len(_SESSIONS) > SESSION_CACHE_SIZE:
+                _SESSIONS.popitem(last=False)
+    metrics.AUTH_SECONDS.observe(time.perf_counter() - start, ("miss",))
+    return user_id
+
+def invalidate_device(device_id):
+    """Drops all sessions of a device"""
+    with _SESSIONS_LOCK:
+        for authorization_header, session in list(_SESSIONS.items()):
+            if session.device["id"] == device_id:
+                del _SESSIONS[authorization_header]
+
+def session_count():
+    with _SESSIONS_LOCK:
+        return len(_SESSIONS)
+
+metrics.AUTH_SESSIONS.function = session_count
+
+def add_arguments(parser):
+    parser.add_argument("--session-cache-size", type=int, default=SESSION_CACHE_SIZE, metavar="N",
+                        help="authenticated sessions to keep, 0 disables the cache")
+    parser.add_argument("--session-ttl", type=float, default=SESSION_TTL, metavar="SECONDS",
+                        help="time after which cached credentials are verified again")
+
+def configure(args):
+    global SESSION_CACHE_SIZE, SESSION_TTL
+    SESSION_CACHE_SIZE = args.session_cache_size
+    SESSION_TTL = args.session_ttl
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+#pylint:disable=missing-docstring,invalid-name
+"""Load generator and benchmark for the dummy REST and websocket servers
+
+Runs these scenarios in order against localhost:
+  register_user, register_device  POST /users and POST /devices per user
+  create_conversation             POST /conversations, one per user with
+                                  the next user as second participant
+  rest_message                    POST /messages into the user's conversation
+  ws_message                      websocket message.new, same conversations
+  page_messages                   GET /conversations/{id}/messages, all pages
+  upload_blob, download_blob      PUT and GET /blob/{id}
+
+For each scenario, throughput and latency percentiles are printed and, with
+--output, written as JSON to compare server and storage modes between runs.
+With --spawn, rest.py and websocket.py are started in a temporary working
+directory and stopped afterwards. --backends json,sqlite repeats the run for
+each storage backend and prints which one is faster per scenario. Payloads are generated from --seed, so runs
+with the same arguments send the same data.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import http.client
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import websockets
+
+import blobstore
+import rest
+import storage
+import websocket
+
+HOST = "localhost"
+SERVER_START_TIMEOUT = 10 # seconds
+
+class Recorder:
+    """Collects the latencies and errors of one scenario"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.started = None
+        self.finished = None
+
+    def record(self, seconds, ok=True):
+        with self.lock:
+            self.latencies.append(seconds)
+            if not ok:
+                self.errors += 1
+
+    @contextlib.contextmanager
+    def running(self):
+        self.started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.finished = time.perf_counter()
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        elapsed = self.finished - self.started
+
+        def percentile(p):
+            if not latencies:
+                return None
+            rank = max(int(round(p / 100 * len(latencies))) - 1, 0)
+            return round(1000 * latencies[rank], 3)
+
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "seconds": round(elapsed, 3),
+            "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "latencyMs": {
+                "mean": round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": percentile(100),
+            },
+        }
+
+class RestClient:
+    """One keep-alive HTTP connection per thread"""
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def request(self, recorder, method, path, body=None, headers=None, expected=(200,)):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(HOST, self.port)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self.local.connection = None
+            recorder.record(time.perf_counter() - start, ok=False)
+            return None, None
+        ok = response.status in expected
+        recorder.record(time.perf_counter() - start, ok)
+        return response.status, data
+
+class WebsocketClient:
+    """Sends requests and matches responses by request ID, discards events"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.pending = {}
+        self.next_id = 1
+        self.events = 0
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        try:
+            async for frame in self.connection:
+                message = json.loads(frame)
+                if message["type"] == "response":
+                    future = self.pending.pop(message["meta"]["requestId"], None)
+                    if future:
+                        future.set_result(message)
+                else:
+                    self.events += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        for future in self.pending.values():
+            future.cancel()
+
+    async def request(self, request_type, data):
+        request_id = self.next_id
+        self.next_id += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        await self.connection.send(json.dumps({"id": request_id, "type": request_type, "data": data}))
+        return await future
+
+    async def close(self):
+        await self.connection.close()
+        await self.reader
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.client = RestClient(rest.PORT)
+        self.recorders = {}
+        # unique per run so that repeated runs against one server don't collide
+        self.run_tag = os.urandom(4).hex()
+        self.users = [] # dicts with id, device ID, conversation ID and key ID
+        self.last_message_ids = {} # conversation ID -> ID of the latest message
+
+    def rng(self, *seed_parts):
+        return random.Random("{}-{}".format(self.args.seed, "-".join(map(str, seed_parts))))
+
+    def parallel(self, name, function, items):
+        recorder = self.recorders[name] = Recorder()
+        with recorder.running(), \
+                concurrent.futures.ThreadPoolExecutor(self.args.concurrency) as executor:
+            for _ in executor.map(lambda item: function(recorder, item), items):
+                pass
+
+    def register(self):
+        def register_user(recorder, number):
+            rng = self.rng("user", number)
+            status, data = self.client.request(recorder, "POST", "/users", {
+                "email": "bench-{}-{}@example.com".format(self.run_tag, number),
+                "name": "Benchmark user {}".format(number),
+                "loginKey": "{:064x}".format(rng.getrandbits(256)),
+                "encryptionPubkey": "{:0256x}".format(rng.getrandbits(1024)),
+                "encryptionPrivkey": "{:0512x}".format(rng.getrandbits(2048)),
+            })
+            if status == 200:
+                return {"id": json.loads(data)["user"]["id"], "number": number}
+            return None
+
+        recorder = self.recorders["register_user"] = Recorder()
+        with recorder.running(), \
+                concurrent.futures.ThreadPoolExecutor(self.args.concurrency) as executor:
+            self.users = [
+                user
+                for user in executor.map(lambda n: register_user(recorder, n), range(self.args.users))
+                if user
+            ]
+
+        def register_device(recorder, user):
+            rng = self.rng("device", user["number"])
+            user["deviceId"] = "{:016x}".format(rng.getrandbits(64))
+            self.client.request(recorder, "POST", "/devices", {"device": {
+                "id": user["deviceId"],
+                "ownerId": user["id"],
+                "pubkey": "{:0128x}".format(rng.getrandbits(512)),
+            }})
+        self.parallel("register_device", register_device, self.users)
+
+    def create_conversations(self):
+        def create_conversation(recorder, index):
+            user = self.users[index]
+            partner = self.users[(index + 1) % len(self.users)]
+            rng = self.rng("conversation", user["number"])
+            user["conversationId"] = "{:016x}".format(rng.getrandbits(64))
+            user["conversationKeyId"] = "{:016x}".format(rng.getrandbits(64))
+            participant_ids = sorted({user["id"], partner["id"]})
+            self.client.request(recorder, "POST", "/conversations", {
+                "conversation": {
+                    "id": user["conversationId"],
+                    "type": "group",
+                    "title": "Benchmark conversation {}".format(user["number"]),
+                    "participantIds": participant_ids,
+                },
+                "permissions": [
+                    {
+                        "ownerId": owner_id,
+                        "conversationId": user["conversationId"],
+                        "conversationKeyId": user["conversationKeyId"],
+                        "conversationKey": "{:064x}".format(rng.getrandbits(256)),
+                    }
+                    for owner_id in participant_ids
+                ],
+            }, expected=(204,))
+            self.last_message_ids[user["conversationId"]] = 0
+        self.parallel("create_conversation", create_conversation, range(len(self.users)))
+
+    def new_message(self, user, number):
+        rng = self.rng("message", user["number"], number)
+        return {
+            "context": {
+                "version": 1,
+                "conversationKeyId": user["conversationKeyId"],
+                "previousMessageId": self.last_message_ids[user["conversationId"]],
+                "deviceKeyId": user["deviceId"],
+            },
+            "encryptedMessage": "{:x}".format(rng.getrandbits(8 * self.args.message_size)),
+        }
+
+    def post_rest_messages(self):
+        def post_messages(recorder, user):
+            for number in range(self.args.messages):
+                status, data = self.client.request(
+                    recorder, "POST", "/messages", self.new_message(user, number), expected=(201,))
+                if status == 201:
+                    self.last_message_ids[user["conversationId"]] = json.loads(data)["id"]
+        self.parallel("rest_message", post_messages, self.users)
+
+    def post_websocket_messages(self):
+        recorder = self.recorders["ws_message"] = Recorder()
+        setup_recorder = Recorder()
+
+        async def connect(user):
+            authorization = 'KULLO_V1 loginKey="", deviceId="{}", signature=""'.format(user["deviceId"])
+            _, data = await asyncio.get_event_loop().run_in_executor(
+                None, lambda: self.client.request(
+                    setup_recorder, "POST", "/ws_urls", b"", {"Authorization": authorization}, expected=(201,)))
+            url = json.loads(data)["socketUrl"]
+            return WebsocketClient(await websockets.connect(url, max_size=None))
+
+        async def post_messages(user, semaphore):
+            async with semaphore:
+                client = await connect(user)
+                try:
+                    for number in range(self.args.messages):
+                        message = self.new_message(user, self.args.messages + number)
+                        start = time.perf_counter()
+                        response = await client.request("message.new", message)
+                        ok = response["meta"]["error"] is None
+                        recorder.record(time.perf_counter() - start, ok)
+                        if ok:
+                            self.last_message_ids[user["conversationId"]] = response["data"]["id"]
+                finally:
+                    await client.close()
+
+        async def post_all():
+            semaphore = asyncio.Semaphore(self.args.concurrency)
+            await asyncio.gather(*[post_messages(user, semaphore) for user in self.users])
+
+        with recorder.running():
+            asyncio.run(post_all())
+
+    def page_messages(self):
+        def page_conversation(recorder, user):
+            path = "/conversations/{}/messages?limit={}".format(user["conversationId"], self.args.page_size)
+            cursor = None
+            while True:
+                page_path = path + ("&cursor={}".format(cursor) if cursor else "")
+                status, data = self.client.request(recorder, "GET", page_path)
+                if status != 200:
+                    return
+                cursor = json.loads(data)["meta"]["nextCursor"]
+                if not cursor:
+                    return
+        self.parallel("page_messages", page_conversation, self.users)
+
+    def transfer_blobs(self):
+        blobs = [
+            (user, number, "bench{}{}x{}".format(self.run_tag, user["number"], number))
+            for user in self.users
+            for number in range(self.args.blobs)
+        ]
+
+        def content(user, number):
+            rng = self.rng("blob", user["number"], number)
+            return rng.getrandbits(8 * self.args.blob_size).to_bytes(self.args.blob_size, "big")
+
+        def upload(recorder, blob):
+            user, number, blob_id = blob
+            self.client.request(recorder, "PUT", "/blob/{}".format(blob_id), content(user, number),
+                                {"Content-Type": "application/octet-stream"}, expected=(204,))
+        self.parallel("upload_blob", upload, blobs)
+
+        def download(recorder, blob):
+            user, number, blob_id = blob
+            status, data = self.client.request(recorder, "GET", "/blob/{}".format(blob_id))
+            if status == 200 and data != content(user, number):
+                recorder.record(0, ok=False)
+        self.parallel("download_blob", download, blobs)
+
+    def run(self):
+        self.register()
+        if not self.users:
+            raise RuntimeError("No user could be registered")
+        self.create_conversations()
+        self.post_rest_messages()
+        self.post_websocket_messages()
+        self.page_messages()
+        self.transfer_blobs()
+        return {name: recorder.summary() for name, recorder in self.recorders.items()}
+
+def wait_for_port(port, process):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with code {}".format(process.returncode))
+        with contextlib.suppress(OSError), socket.create_connection((HOST, port), timeout=1):
+            return
+        time.sleep(0.1)
+    raise RuntimeError("Server did not start listening on port {}".format(port))
+
+@contextlib.contextmanager
+def spawned_servers(args, backend=None):
+    """Starts rest.py and websocket.py with an empty database in a temporary directory"""
+    workdir = tempfile.mkdtemp(prefix="kullo-benchmark-")
+    processes = []
+    try:
+        database_dir = os.path.join(workdir, storage.DATABASE_DIR)
+        os.mkdir(database_dir)
+        os.mkdir(os.path.join(workdir, blobstore.BLOB_DIR))
+        for path, content in [
+                (storage.DATABASE_FILE_USERS, []),
+                (storage.DATABASE_FILE_DEVICES, {}),
+                (storage.DATABASE_FILE_CONVERSATIONS, []),
+                (storage.DATABASE_FILE_CONVERSATION_PERMISSIONS, []),
+        ]:
+            with open(os.path.join(workdir, path), "w") as f:
+                json.dump(content, f)
+
+        server_dir = os.path.dirname(os.path.abspath(__file__))
+        log = open(os.path.join(workdir, "servers.log"), "wb")
+        for script, script_args, port in [
+                ("rest.py", args.rest_args, rest.PORT),
+                ("websocket.py", args.ws_args, websocket.PORT),
+        ]:
+            command = [sys.executable, os.path.join(server_dir, script)] + shlex.split(script_args)
+            if backend:
+                command += ["--backend", backend]
+            process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+            processes.append(process)
+            wait_for_port(port, process)
+        yield workdir
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if args.keep:
+            print("Kept working directory {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+def print_results(results):
+    print("{:<20} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "scenario", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name, result in results.items():
+        latency = result["latencyMs"]
+        print("{:<20} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            name, result["requests"], result["errors"], result["throughput"],
+            latency["p50"], latency["p90"], latency["p99"], latency["max"]))
+
+def print_comparison(results_by_backend):
+    backends = list(results_by_backend)
+    print("{:<20} ".format("req/s") + " ".join("{:>9}".format(b) for b in backends) + "  fastest")
+    for name in results_by_backend[backends[0]]:
+        throughputs = [results_by_backend[b][name]["throughput"] or 0 for b in backends]
+        fastest = backends[throughputs.index(max(throughputs))]
+        print("{:<20} ".format(name) + " ".join("{:>9}".format(t) for t in throughputs) + "  " + fastest)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20,
+                        help="messages per user and transport")
+    parser.add_argument("--message-size", type=int, default=256, help="bytes of encrypted payload")
+    parser.add_argument("--page-size", type=int, default=rest.PAGE_SIZE_MESSAGES)
+    parser.add_argument("--blobs", type=int, default=2, help="blobs per user")
+    parser.add_argument("--blob-size", type=int, default=256 * 1024)
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="simultaneous clients")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", metavar="FILE", help="write results as JSON")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start the servers in a temporary directory")
+    parser.add_argument("--rest-args", default="", help="arguments for rest.py with --spawn")
+    parser.add_argument("--ws-args", default="", help="arguments for websocket.py with --spawn")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the temporary directory of --spawn")
+    parser.add_argument("--backends", metavar="NAMES",
+                        help="with --spawn, run once per storage backend and compare, e.g. {}".format(
+                            ",".join(storage.BACKENDS)))
+    args = parser.parse_args()
+    if args.backends and not args.spawn:
+        parser.error("--backends requires --spawn")
+
+    output = {
+        "config": vars(args),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    if args.backends:
+        output["backends"] = {}
+        for backend in args.backends.split(","):
+            with spawned_servers(args, backend):
+                results = output["backends"][backend] = Benchmark(args).run()
+            print("Backend {}:".format(backend))
+            print_results(results)
+            print()
+        print_comparison(output["backends"])
+        all_results = [r for results in output["backends"].values() for r in results.values()]
+    else:
+        with spawned_servers(args) if args.spawn else contextlib.nullcontext():
+            results = output["scenarios"] = Benchmark(args).run()
+        print_results(results)
+        all_results = list(results.values())
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    return 1 if any(result["errors"] for result in all_results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
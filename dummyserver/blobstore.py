@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#pylint:disable=missing-docstring,invalid-name
+"""Content-addressed blob store
+
+Blob content is stored once per SHA-256 hash at objects/ab/cd/abcd…, sharded
+by hash prefix to keep directories small. storage.py maps blob IDs to hashes
+and counts the references to every hash. Uploading identical content under
+another ID does not store a second copy.
+
+Run `blobstore.py gc` to delete objects no blob ID references anymore.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import metrics
+import storage
+
+BLOB_DIR = "blob_dir"
+OBJECTS_DIR = os.path.join(BLOB_DIR, "objects")
+CHUNK_SIZE = 64 * 1024
+# Objects younger than this are never collected, they might belong to an
+# upload whose blob ID has not been stored yet.
+GC_GRACE_PERIOD = 3600
+
+def object_path(content_hash):
+    return os.path.join(OBJECTS_DIR, content_hash[0:2], content_hash[2:4], content_hash)
+
+def legacy_path(blob_id):
+    return os.path.join(BLOB_DIR, "{}.bin".format(blob_id))
+
+def store_blob(blob_id, stream, length):
+    """Reads `length` bytes from `stream` and stores them as the content of
+    `blob_id`. Returns the content hash."""
+    content_hash = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            remaining = length
+            while remaining > 0:
+                chunk = stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("Upload ended prematurely")
+                content_hash.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+            metrics.STORAGE_BYTES_WRITTEN.inc(length, ("blob",))
+            if storage.DURABLE_WRITES:
+                os.fsync(f.fileno())
+
+        path = object_path(content_hash.hexdigest())
+        if os.path.exists(path):
+            # deduplicated, refresh mtime for the GC grace period
+            os.utime(path)
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    storage.set_blob_content(blob_id, content_hash.hexdigest(), length)
+    return content_hash.hexdigest()
+
+def open_blob(blob_id):
+    """Returns (file, content hash). The hash is None for blobs stored before
+    the content-addressed layout. Raises FileNotFoundError."""
+    blob = storage.get_blob(blob_id)
+    if blob and blob["hash"]:
+        return open(object_path(blob["hash"]), "rb"), blob["hash"]
+    return open(legacy_path(blob_id), "rb"), None
+
+def collect_garbage(dry_run=False, grace_period=GC_GRACE_PERIOD):
+    """Deletes unreferenced objects, returns their count and total size"""
+    reference_counts = storage.get_blob_reference_counts()
+    threshold = time.time() - grace_period
+    removed_count = 0
+    removed_size = 0
+    for directory, _, filenames in os.walk(OBJECTS_DIR):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            stat_result = os.stat(path)
+            if reference_counts.get(filename, 0) or stat_result.st_mtime > threshold:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed_count += 1
+            removed_size += stat_result.st_size
+    return removed_count, removed_size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    gc_parser = subparsers.add_parser("gc", help="delete unreferenced blob objects")
+    gc_parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+    gc_parser.add_argument("--grace-period", type=int, default=GC_GRACE_PERIOD,
+                           help="seconds for which new objects are kept")
+    args = parser.parse_args()
+
+    if args.command == "gc":
+        count, size = collect_garbage(args.dry_run, args.grace_period)
+        print("{} {} unreferenced blobs ({} bytes)".format(
+            "Would remove" if args.dry_run else "Removed", count, size))
+        return 0
+
+    parser.print_help()
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,13 @@ set -o errexit -o nounset -o pipefail
 which shellcheck > /dev/null && (shellcheck -x "$0" || shellcheck "$0")
 
 rm blob_dir/*.bin || true
-rm database_dir/messages_*.json || true
+rm -rf blob_dir/objects
+rm database_dir/messages_* || true
+rm -f database_dir/changes.jsonl database_dir/changes.idx
+rm -f database_dir/*.snapshot
 
 echo "{}" > database_dir/devices.json
 echo "[]" > database_dir/users.json
 echo "[]" > database_dir/conversations.json
 echo "[]" > database_dir/conversation_permissions.json
+rm -f database_dir/blobs.json database_dir/blobs.jsonl
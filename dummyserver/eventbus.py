@@ -0,0 +1,119 @@
+#pylint:disable=missing-docstring,invalid-name
+import asyncio
+import json
+import os
+import socket
+import struct
+import tempfile
+
+# Local publish/subscribe bus connecting the websocket worker processes. The
+# broker runs in the supervisor process and listens on a Unix domain socket.
+# Every event a worker publishes is forwarded to all other workers, which
+# deliver it to their own connections.
+#
+# Frames are a 4 byte length followed by the payload. The payload is a JSON
+# header [conversation ID, event type], a line break and the serialized event,
+# which is forwarded without being parsed again.
+
+FRAME_HEADER = struct.Struct(">I")
+RECONNECT_DELAY = 1.0 # seconds
+LISTEN_BACKLOG = 128
+
+def default_socket_path(port):
+    return os.path.join(tempfile.gettempdir(), "kullo-websocket-{}.sock".format(port))
+
+def encode_frame(conversation_id, event_type, event_bytes):
+    payload = json.dumps([conversation_id, event_type]).encode() + b"\n" + event_bytes
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+async def read_frame(reader):
+    """Returns the next payload or None at the end of the stream"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        return await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+def decode_payload(payload):
+    """Returns conversation ID, event type and serialized event"""
+    header, _, event_bytes = payload.partition(b"\n")
+    conversation_id, event_type = json.loads(header)
+    return conversation_id, event_type, event_bytes
+
+class Broker:
+    def __init__(self, path):
+        self.path = path
+        self.writers = set()
+        self.sock = None
+
+    def bind(self):
+        """Listens on the socket. Workers can connect from then on, their
+        connections are accepted once the broker has been started."""
+        if os.path.exists(self.path):
+            os.remove(self.path) # left over by a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(LISTEN_BACKLOG)
+
+    async def start(self):
+        if self.sock is None:
+            self.bind()
+        return await asyncio.start_unix_server(self.handle_worker, sock=self.sock)
+
+    async def handle_worker(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                payload = await read_frame(reader)
+                if payload is None:
+                    return
+                frame = FRAME_HEADER.pack(len(payload)) + payload
+                for other in self.writers:
+                    if other is not writer:
+                        other.write(frame)
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+class BusClient:
+    """Connection of a worker to the broker
+
+    `on_event` is called with conversation ID, event type and serialized
+    event for every event published by another worker. Events published
+    while the broker is unreachable are lost.
+    """
+
+    def __init__(self, path, on_event):
+        self.path = path
+        self.on_event = on_event
+        self.writer = None
+        self.connected = asyncio.Event()
+
+    def publish(self, conversation_id, event_type, event_bytes):
+        if self.writer:
+            self.writer.write(encode_frame(conversation_id, event_type, event_bytes))
+
+    async def run(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except (ConnectionError, FileNotFoundError):
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            self.connected.set()
+            try:
+                while True:
+                    payload = await read_frame(reader)
+                    if payload is None:
+                        break
+                    await self.on_event(*decode_payload(payload))
+            except ConnectionError:
+                pass
+            finally:
+                self.connected.clear()
+                self.writer.close()
+                self.writer = None
+            print("Lost connection to the event bus at {}, reconnecting".format(self.path))
+            await asyncio.sleep(RECONNECT_DELAY)
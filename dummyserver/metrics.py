@@ -0,0 +1,186 @@
+#pylint:disable=missing-docstring,invalid-name
+import bisect
+import functools
+import threading
+import time
+
+# Process-wide metrics, exposed in the Prometheus text format by render().
+# Updates take one uncontended lock and a dict update, cheap enough to stay
+# enabled in production.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, from well below a cached read to a slow fsync
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+FAN_OUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+_REGISTRY = []
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    ) + "}"
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {} # label values tuple -> value
+        _REGISTRY.append(self)
+
+    def samples(self):
+        """Returns (name, label pairs, value) tuples"""
+        with self.lock:
+            return [
+                (self.name, list(zip(self.label_names, labels)), value)
+                for labels, value in sorted(self.values.items())
+            ]
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        for name, pairs, value in self.samples():
+            lines.append("{}{} {}".format(name, format_labels(pairs), value))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def totals(self):
+        with self.lock:
+            return sum(self.values.values())
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from `function` when rendered"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), function=None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def samples(self):
+        if self.function:
+            return [(self.name, [], self.function())]
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # per-bucket counts, sum of values
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def totals(self):
+        """Returns count and sum of all observations"""
+        with self.lock:
+            return (
+                sum(sum(counts) for counts, _ in self.values.values()),
+                sum(total for _, total in self.values.values()),
+            )
+
+    def samples(self):
+        with self.lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in sorted(self.values.items())]
+        out = []
+        for labels, counts, total in snapshot:
+            pairs = list(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                out.append((self.name + "_bucket", pairs + [("le", bound)], cumulative))
+            out.append((self.name + "_sum", pairs, total))
+            out.append((self.name + "_count", pairs, cumulative))
+        return out
+
+def timed(histogram, labels=()):
+    """Decorator observing the duration of each call of the decorated function"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, labels)
+        return wrapper
+    return decorator
+
+def render():
+    return "\n".join(metric.render() for metric in _REGISTRY) + "\n"
+
+# Metrics shared by the modules of both servers
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "REST request latency by route",
+    ("method", "route", "status"))
+HTTP_RESPONSE_BYTES = Counter(
+    "http_response_bytes_total", "REST response body bytes written", ("route",))
+HTTP_CONNECTIONS = Gauge(
+    "http_active_connections", "Open REST client connections")
+AUTH_SESSION_LOOKUPS = Counter(
+    "auth_session_lookups_total", "Session cache lookups of REST authentication by result", ("result",))
+AUTH_SESSIONS = Gauge(
+    "auth_cached_sessions", "Authenticated sessions in the REST session cache")
+AUTH_SECONDS = Histogram(
+    "auth_duration_seconds", "Duration of REST authentication, with and without a cached session",
+    ("cache",))
+
+WEBSOCKET_REQUEST_SECONDS = Histogram(
+    "websocket_request_duration_seconds", "Websocket request latency by request type",
+    ("type", "error"))
+WEBSOCKET_CONNECTIONS = Gauge(
+    "websocket_active_connections", "Open websocket connections")
+WEBSOCKET_SENT_FRAMES = Counter(
+    "websocket_sent_frames_total", "Frames sent to websocket clients")
+WEBSOCKET_SENT_BYTES = Counter(
+    "websocket_sent_bytes_total", "Payload bytes sent to websocket clients", ("encoding",))
+WEBSOCKET_COMPRESSED_BYTES = Counter(
+    "websocket_sent_compressed_bytes_total",
+    "Payload bytes of data frames sent on connections with permessage-deflate, after compression")
+WEBSOCKET_SEND_SECONDS = Histogram(
+    "websocket_send_latency_seconds", "Time frames spend queued in a connection's outbox")
+WEBSOCKET_DROPPED_CONNECTIONS = Counter(
+    "websocket_dropped_connections_total", "Connections dropped for being too slow")
+BROADCAST_FAN_OUT = Histogram(
+    "websocket_broadcast_receivers", "Receiving connections per broadcast event",
+    buckets=FAN_OUT_BUCKETS)
+
+STORAGE_OPERATION_SECONDS = Histogram(
+    "storage_operation_duration_seconds", "Duration of storage functions", ("function",))
+STORAGE_BYTES_WRITTEN = Counter(
+    "storage_bytes_written_total", "Bytes written to database files", ("kind",))
@@ -0,0 +1,30 @@
+#pylint:disable=missing-docstring,invalid-name
+
+# Request parameters and response bodies shared by the REST and the websocket
+# API, so that both servers answer the same requests the same way.
+
+PAGE_SIZE_CHANGES = 100
+MAX_PAGE_SIZE_CHANGES = 1000
+# User fields visible to other users, in particular without key material
+PUBLIC_USER_FIELDS = ("id", "state", "name", "email", "picture", "encryptionPubkey")
+
+def parse_sync_params(cursor, since, limit):
+    """Returns cursor, since and limit of a sync request, raises ValueError"""
+    cursor = int(cursor) if cursor is not None else None
+    if cursor is not None and cursor < 0:
+        raise ValueError("Negative cursor")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE_CHANGES)) if limit is not None else PAGE_SIZE_CHANGES
+    return cursor, since, limit
+
+def sync_response_body(changes, next_cursor, more_available):
+    return {
+        "objects": changes,
+        "meta": {
+            "nextCursor": str(next_cursor),
+            "moreAvailable": more_available,
+        },
+    }
+
+def project(objects, fields):
+    """Copies of the objects reduced to the given fields"""
+    return [{name: o[name] for name in fields if name in o} for o in objects]
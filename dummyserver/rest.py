@@ -2,316 +2,518 @@
 #pylint:disable=missing-docstring
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
+import argparse
+import asyncio
 import json
 import os
 import re
 import socketserver
+import time
 import urllib
 
+import async_http
+import auth
+import blobstore
+import metrics
+import protocol
+import serialization
 import storage
 
-GET_DEVICE_MATCHER = re.compile('^/devices/([a-f0-9]+)$')
-GET_CONVERSATION_MESSAGES_MATCHER = re.compile('^/conversations/([a-f0-9]+)/messages$')
-GET_BLOB_MATCHER = re.compile('^/blob/([a-zA-Z0-9]+)$')
-PUT_BLOB_MATCHER = re.compile('^/blob/([a-zA-Z0-9]+)$')
+HOST = ""
+PORT = 8000
 PAGE_SIZE_MESSAGES = 25
-BLOB_DIR="blob_dir"
+MAX_PAGE_SIZE_MESSAGES = 100
+PAGE_SIZE_CONVERSATIONS = 100
+MAX_PAGE_SIZE_CONVERSATIONS = 1000
+PAGE_SIZE_USERS = 100
+MAX_PAGE_SIZE_USERS = 1000
+BLOB_CHUNK_SIZE = 64 * 1024
+BYTE_RANGE_MATCHER = re.compile(r'^bytes=(\d*)-(\d*)$')
+ROUTE_PARAM_MATCHER = re.compile(r'\(\?P<(\w+)>')
 
-def key_id_to_conv_id(keyId):
-    table = {}
-    for permission in storage.get_all_conversation_permissions():
-        table[permission["conversationKeyId"]] = permission["conversationId"]
-    return table[keyId]
+class Router:
+    """Maps HTTP method and path to a handler name and path parameters
 
-class MyRequestHandler(BaseHTTPRequestHandler):
-    def authorization_params(self):
-        authorization_header = self.headers.get('Authorization')
-        if authorization_header:
-            params_matcher = re.compile(r'(\w+)= ?"([^"]+)"')
-            authorization_header = authorization_header.replace("KULLO_V1", "").strip()
-            params = dict(params_matcher.findall(authorization_header))
-            return params
-        else:
-            return None
+    Routes are (method, path, handler name) tuples. Paths are literal or
+    regular expressions with named groups for the parameters. Literal paths
+    are found with a dict lookup, all patterns of one method are combined
+    into a single precompiled expression.
+    """
+
+    def __init__(self, routes):
+        self.static_routes = {}
+        patterns = {}
+        self.pattern_handlers = {}
+        for index, (method, path, handler_name) in enumerate(routes):
+            if "(?P<" not in path:
+                self.static_routes[(method, path)] = handler_name
+                continue
+            route_group = "r{}".format(index)
+            prefixed_path = ROUTE_PARAM_MATCHER.sub(r'(?P<{}_\1>'.format(route_group), path)
+            patterns.setdefault(method, []).append("(?P<{}>{})".format(route_group, prefixed_path))
+            self.pattern_handlers[route_group] = handler_name
+        self.patterns = {
+            method: re.compile("^(?:{})$".format("|".join(method_patterns)))
+            for method, method_patterns in patterns.items()
+        }
+
+    def match(self, method, path):
+        """Returns (handler name, parameters) or (None, None)"""
+        handler_name = self.static_routes.get((method, path))
+        if handler_name:
+            return handler_name, {}
+        pattern = self.patterns.get(method)
+        match = pattern.match(path) if pattern else None
+        if not match:
+            return None, None
+        prefix = match.lastgroup + "_"
+        params = {
+            name[len(prefix):]: value
+            for name, value in match.groupdict().items()
+            if name.startswith(prefix)
+        }
+        return self.pattern_handlers[match.lastgroup], params
+
+ROUTER = Router([
+    ("GET", "/conversations", "get_conversations"),
+    ("GET", r"/conversations/(?P<conversation_id>[a-f0-9]+)/messages", "get_conversation_messages"),
+    ("GET", "/conversation_permissions", "get_conversation_permissions"),
+    ("GET", "/devices", "get_devices"), # Undocumented debugging endpoint
+    ("GET", r"/devices/(?P<device_id>[a-f0-9]+)", "get_device"),
+    ("GET", "/cache_stats", "get_cache_stats"), # Undocumented debugging endpoint
+    ("GET", "/users", "get_users"),
+    ("GET", "/metrics", "get_metrics"),
+    ("GET", "/sync", "get_sync"),
+    ("GET", r"/blob/(?P<blob_id>[a-zA-Z0-9]+)", "get_blob"),
+    ("POST", "/messages", "post_message"),
+    ("POST", "/users/get_me", "post_users_get_me"),
+    ("POST", "/users", "post_user"),
+    ("POST", "/conversations", "post_conversation"),
+    ("POST", "/devices", "post_device"),
+    ("POST", "/ws_urls", "post_ws_url"),
+    ("PUT", r"/blob/(?P<blob_id>[a-zA-Z0-9]+)", "put_blob"),
+])
+
+def parse_page_params(query, page_size, max_page_size, cursor_type=str):
+    """Returns cursor (the last ID of the previous page or None) and page
+    size of a paginated request, raises ValueError"""
+    query = query or {}
+    cursor = query.get("cursor", [None])[0]
+    cursor = cursor_type(cursor) if cursor else None
+    limit = query.get("limit", [None])[0]
+    limit = max(1, min(int(limit), max_page_size)) if limit is not None else page_size
+    return cursor, limit
 
+def parse_fields(query, allowed_fields=None):
+    """Returns the field names of a comma separated `fields` parameter or
+    None for all fields, raises ValueError for fields that are not allowed"""
+    values = (query or {}).get("fields")
+    if not values:
+        return None
+    fields = [name for value in values for name in value.split(",") if name]
+    if allowed_fields is not None and not set(fields).issubset(allowed_fields):
+        raise ValueError("Unknown fields: {}".format(", ".join(set(fields) - set(allowed_fields))))
+    return fields
+
+def page_response_body(objects, last_id, more_available, related=None):
+    out = {
+        "objects": objects,
+        "meta": {
+            "nextCursor": str(last_id) if more_available else None,
+        },
+    }
+    if related is not None:
+        out["related"] = related
+    return out
+
+def blob_etag(content_hash, stat_result):
+    if content_hash:
+        return '"{}"'.format(content_hash)
+    return '"{:x}-{:x}"'.format(stat_result.st_mtime_ns, stat_result.st_size)
+
+def parse_byte_range(range_header, size):
+    """Returns (first, last) for a single byte range, None if the header
+    is not supported (whole file is sent) and raises ValueError if the
+    range cannot be satisfied."""
+    match = BYTE_RANGE_MATCHER.match(range_header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        raise ValueError("Unsatisfiable range")
+    return first, last
+
+class MyRequestHandler(BaseHTTPRequestHandler):
     def authenticated_user_id(self):
-        params = self.authorization_params()
-        device_id = params["deviceId"]
-        device = storage.get_device(device_id)
-        # TODO: use device's pubkey to verify signature
-        # TODO: check loginKey
-        user_id = device["ownerId"]
-        return user_id
+        """Returns the authenticated user's ID or None"""
+        return auth.authenticate(self.headers.get('Authorization'))
 
-    def do_GET(self): #pylint:disable=invalid-name
-        parts = self.path.split("?")
-        path = parts[0]
-        query = urllib.parse.parse_qs(parts[1]) if len(parts) > 1 else None
+    def handle(self):
+        metrics.HTTP_CONNECTIONS.inc()
+        try:
+            super().handle()
+        finally:
+            metrics.HTTP_CONNECTIONS.dec()
 
-        #print("Authenticated user:", self.authenticated_user_id())
+    def send_headers(self, status, headers=()):
+        self.response_status = status
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
 
-        match = GET_CONVERSATION_MESSAGES_MATCHER.match(path)
-        if match:
-            conversation_id = match.group(1)
-            try:
-                possible_messages = storage.get_all_messages(conversation_id)
-                if query and query["cursor"]:
-                    upper_id_limit = int(query["cursor"][0])
-                    possible_messages = [m for m in possible_messages if m["id"] < upper_id_limit]
-
-                messages_for_this_page = possible_messages[-PAGE_SIZE_MESSAGES:]
-
-                if len(messages_for_this_page) < len(possible_messages):
-                    # more messages available
-                    earliest_delivered_id = messages_for_this_page[0]["id"]
-                    next_cursor = str(earliest_delivered_id)
-                else:
-                    next_cursor = None
-
-                out = {
-                    "objects": list(reversed(messages_for_this_page)),
-                    "meta": {
-                        "nextCursor": next_cursor,
-                    },
-                }
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps(out, indent=2).encode())
-                return
-            except FileNotFoundError:
-                self.send_response(404)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
+    def send_json(self, status, obj):
+        body = serialization.dumps_bytes(obj)
+        self.send_headers(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ])
+        self.wfile.write(body)
+        metrics.HTTP_RESPONSE_BYTES.inc(len(body), (self.route,))
+
+    def read_json_body(self):
+        content_len = int(self.headers.get('content-length', 0))
+        return json.loads(self.rfile.read(content_len))
+
+    def dispatch(self, method):
+        path, _, query_string = self.path.partition("?")
+        query = urllib.parse.parse_qs(query_string) if query_string else None
+
+        start = time.perf_counter()
+        handler_name, params = ROUTER.match(method, path)
+        self.route = handler_name or "unknown"
+        self.response_status = None
+        try:
+            if not handler_name:
+                self.send_headers(404)
                 return
+            getattr(self, handler_name)(query, **params)
+        finally:
+            metrics.HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, (method, self.route, self.response_status or 500))
 
-        if path == "/conversations":
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            conversations = storage.get_all_conversations()
-            permissions = storage.get_all_conversation_permissions()
-            out = {
-                "objects": conversations,
-                "related": {
-                    "permissions": permissions,
-                },
-                "meta": {
-                    "nextCursor": None,
-                },
-            }
-            self.wfile.write(json.dumps(out, indent=2).encode())
+    def do_GET(self): #pylint:disable=invalid-name
+        self.dispatch("GET")
+
+    def do_POST(self): #pylint:disable=invalid-name
+        self.dispatch("POST")
+
+    def do_PUT(self): #pylint:disable=invalid-name
+        self.dispatch("PUT")
+
+    def do_OPTIONS(self): #pylint:disable=invalid-name
+        # required for pre-flight requests Cross-Origin Resource Sharing (CORS)
+        self.send_headers(204, [
+            ('Access-Control-Allow-Methods', 'GET, POST, PUT, OPTIONS'),
+            ('Access-Control-Allow-Headers', 'Content-Type, Authorization, Range, If-None-Match'),
+        ])
+
+    def get_conversation_messages(self, query, conversation_id):
+        try:
+            before_id, page_size = parse_page_params(query, PAGE_SIZE_MESSAGES, MAX_PAGE_SIZE_MESSAGES, int)
+        except ValueError:
+            self.send_headers(400)
             return
 
-        if path == "/conversation_permissions":
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            conversation_permissions = storage.get_all_conversation_permissions()
-            out = {
-                "objects": conversation_permissions,
-                "meta": {
-                    "nextCursor": None,
-                },
-            }
-            self.wfile.write(json.dumps(out, indent=2).encode())
+        try:
+            messages_for_this_page, more_available = storage.get_messages_page(
+                conversation_id, before_id, page_size)
+        except FileNotFoundError:
+            self.send_headers(404)
+            return
+
+        # newest first, the cursor is the earliest delivered ID
+        out = page_response_body(
+            list(reversed(messages_for_this_page)),
+            messages_for_this_page[0]["id"] if messages_for_this_page else None, more_available)
+        self.send_json(200, out)
+
+    def get_conversations(self, query):
+        """Conversations the user participates in or owns a permission for,
+        with the user's permissions for them"""
+        user_id = self.authenticated_user_id()
+        if user_id is None:
+            self.send_headers(401)
             return
 
-        # Undocumented debugging endpoint
-        if path == "/devices":
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            devices = storage.get_all_devices()
-            self.wfile.write(json.dumps(devices, indent=2).encode())
+        try:
+            after_id, limit = parse_page_params(query, PAGE_SIZE_CONVERSATIONS, MAX_PAGE_SIZE_CONVERSATIONS)
+            fields = parse_fields(query)
+        except ValueError:
+            self.send_headers(400)
+            return
+
+        conversations, more_available = storage.get_user_conversations_page(user_id, after_id, limit)
+        conversation_ids = [c["id"] for c in conversations]
+        permissions = storage.get_user_conversation_permissions(user_id, conversation_ids)
+        if fields is not None:
+            conversations = protocol.project(conversations, fields)
+        out = page_response_body(
+            conversations, conversation_ids[-1] if conversation_ids else None, more_available,
+            {"permissions": permissions})
+        self.send_json(200, out)
+
+    def get_conversation_permissions(self, query):
+        """The user's own permissions for the conversations they participate
+        in. Other members' permissions hold their conversation keys and are
+        never returned, neither here nor by GET /sync."""
+        user_id = self.authenticated_user_id()
+        if user_id is None:
+            self.send_headers(401)
             return
 
-        match = GET_DEVICE_MATCHER.match(path)
-        if match:
-            device_id = match.group(1)
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+        conversation_ids = storage.get_user_conversation_ids(user_id)
+        out = page_response_body(
+            storage.get_user_conversation_permissions(user_id, conversation_ids), None, False)
+        self.send_json(200, out)
+
+    def get_devices(self, query):
+        self.send_json(200, storage.get_all_devices())
+
+    def get_device(self, query, device_id):
+        try:
             out = storage.get_device(device_id)
-            self.wfile.write(json.dumps(out, indent=2).encode())
+        except KeyError:
+            self.send_headers(404)
             return
+        self.send_json(200, out)
 
-        if path == "/users":
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            users = storage.get_all_users()
-            out = {
-               "objects": users,
-                "meta": {
-                    "nextCursor": None,
-                },
-            }
-            self.wfile.write(json.dumps(out, indent=2).encode())
+    def get_cache_stats(self, query):
+        self.send_json(200, storage.CACHE_STATS)
+
+    def get_users(self, query):
+        if self.authenticated_user_id() is None:
+            self.send_headers(401)
             return
 
-        match = GET_BLOB_MATCHER.match(path)
-        if match:
-            filename = match.group(1)
-            try:
-                with open(os.path.join(BLOB_DIR, "{}.bin".format(filename)), 'rb') as f:
-                    self.send_response(200)
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.send_header('Content-Type', 'application/octet-stream')
-                    self.end_headers()
-                    self.wfile.write(f.read())
-            except FileNotFoundError:
-                self.send_response(404)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
+        try:
+            after_id, limit = parse_page_params(query, PAGE_SIZE_USERS, MAX_PAGE_SIZE_USERS, int)
+            fields = parse_fields(query, protocol.PUBLIC_USER_FIELDS)
+        except ValueError:
+            self.send_headers(400)
             return
 
-        self.send_response(404)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
+        users, more_available = storage.get_users_page(after_id, limit)
+        out = page_response_body(
+            protocol.project(users, fields or protocol.PUBLIC_USER_FIELDS),
+            users[-1]["id"] if users else None, more_available)
+        self.send_json(200, out)
 
-    def do_POST(self): #pylint:disable=invalid-name
-        content_len = int(self.headers.get('content-length', 0))
-        post_body = self.rfile.read(content_len)
+    def get_metrics(self, query):
+        body = metrics.render().encode()
+        self.send_headers(200, [
+            ('Content-Type', metrics.CONTENT_TYPE),
+            ('Content-Length', str(len(body))),
+        ])
+        self.wfile.write(body)
 
-        if self.path == "/messages":
-            try:
-                server_message = json.loads(post_body)
-                conversation_id = key_id_to_conv_id(server_message["context"]["conversationKeyId"])
-                stored_message = storage.append_message(server_message, conversation_id)
-                self.send_response(201)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(stored_message, indent=2).encode())
-            except storage.WrongPreviousMessageIdInContext:
-                print("Wrong previous message id in context")
-                self.send_response(412) # Precondition Failed
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-        elif self.path == "/users/get_me":
-            data = json.loads(post_body)
-            email = data["email"]
-            user = storage.find_user(email)
-            if user:
-                self.send_response(200)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                out = {
-                    "user": {
-                        "id": user["id"],
-                        "name": user["name"],
-                        "picture": user["picture"],
-                        "encryptionPubkey": user["encryptionPubkey"],
-                    },
-                    "encryptionPrivkey": user["encryptionPrivkey"],
-                }
-                self.wfile.write(json.dumps(out, indent=2).encode())
-            else:
-                self.send_response(403)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-        elif self.path == "/users":
-            data = json.loads(post_body)
+    def get_sync(self, query):
+        """Changes in the user's conversations, permission changes only for
+        the user's own permissions (see storage.change_owner_id)"""
+        user_id = self.authenticated_user_id()
+        if user_id is None:
+            self.send_headers(401)
+            return
+
+        query = query or {}
+        try:
+            cursor, since, limit = protocol.parse_sync_params(
+                query.get("cursor", [None])[0], query.get("since", [None])[0], query.get("limit", [None])[0])
+            changes, next_cursor, more_available = storage.sync_changes(user_id, cursor, since, limit)
+        except ValueError:
+            self.send_headers(400)
+            return
+        self.send_json(200, protocol.sync_response_body(changes, next_cursor, more_available))
+
+    def get_blob(self, query, blob_id):
+        try:
+            f, content_hash = blobstore.open_blob(blob_id)
+            with f:
+                self.send_blob(f, content_hash)
+        except FileNotFoundError:
+            self.send_headers(404)
+
+    def send_blob(self, f, content_hash):
+        stat_result = os.fstat(f.fileno())
+        size = stat_result.st_size
+        etag = blob_etag(content_hash, stat_result)
+
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_headers(304, [('ETag', etag)])
+            return
+
+        first, last = 0, size - 1
+        byte_range = None
+        if self.headers.get('Range') and size:
             try:
-                new_user = storage.append_user(data)
-                response_body = {
-                    "verificationCode": "music pear battery t-shirt",
-                    "user": {
-                        "id": new_user["id"],
-                        "name": new_user["name"],
-                        "email": new_user["email"],
-                        "picture": new_user["picture"],
-                        "encryptionPubkey": new_user["encryptionPubkey"],
-                    }
-                }
-                self.send_response(200)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps(response_body, indent=2).encode())
-            except storage.UserAlreadyExists:
-                self.send_response(409)
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-        elif self.path == "/conversations":
-            data = json.loads(post_body)
-            conversation = data["conversation"]
-            permissions = data["permissions"]
-            storage.create_messages_file(conversation["id"])
-            storage.append_conversation(conversation)
-            for permission in permissions:
-                storage.append_conversation_permission(permission)
-            self.send_response(204)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-        elif self.path == "/devices":
-            data = json.loads(post_body)
-            new_device = storage.append_device(data["device"])
-            self.send_response(200)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(new_device, indent=2).encode())
-        elif self.path == "/ws_urls":
-            user_id = self.authenticated_user_id()
-            url = "ws://localhost:8765/chat_socket?authenticated_user_id={}".format(
-                user_id
-            )
+                byte_range = parse_byte_range(self.headers['Range'], size)
+            except ValueError:
+                # Range Not Satisfiable
+                self.send_headers(416, [('Content-Range', 'bytes */{}'.format(size))])
+                return
+
+        headers = [
+            ('Access-Control-Expose-Headers', 'Content-Length, Content-Range, ETag'),
+            ('Content-Type', 'application/octet-stream'),
+            ('Accept-Ranges', 'bytes'),
+            ('ETag', etag),
+        ]
+        if byte_range:
+            first, last = byte_range
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(first, last, size)))
+        headers.append(('Content-Length', str(last - first + 1)))
+        self.send_headers(206 if byte_range else 200, headers)
+        self.copy_file_to_client(f, first, last - first + 1)
+        metrics.HTTP_RESPONSE_BYTES.inc(last - first + 1, (self.route,))
+
+    def copy_file_to_client(self, f, offset, count):
+        self.wfile.flush()
+        try:
+            socket_fd = self.connection.fileno()
+            while count > 0:
+                sent = os.sendfile(socket_fd, f.fileno(), offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        except (AttributeError, OSError):
+            # no zero-copy support for this connection, fall back to copying
+            f.seek(offset)
+            while count > 0:
+                chunk = f.read(min(BLOB_CHUNK_SIZE, count))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                count -= len(chunk)
+
+    def post_message(self, query):
+        try:
+            server_message = self.read_json_body()
+            conversation_id = storage.get_conversation_id_by_key_id(server_message["context"]["conversationKeyId"])
+            stored_message = storage.append_message(server_message, conversation_id)
+            self.send_json(201, stored_message)
+        except storage.WrongPreviousMessageIdInContext:
+            print("Wrong previous message id in context")
+            self.send_headers(412) # Precondition Failed
+
+    def post_users_get_me(self, query):
+        data = self.read_json_body()
+        email = data["email"]
+        user = storage.find_user(email)
+        if user:
             out = {
-                "socketUrl": url
+                "user": {
+                    "id": user["id"],
+                    "name": user["name"],
+                    "picture": user["picture"],
+                    "encryptionPubkey": user["encryptionPubkey"],
+                },
+                "encryptionPrivkey": user["encryptionPrivkey"],
             }
-            self.send_response(201)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(out, indent=2).encode())
+            self.send_json(200, out)
         else:
-            self.send_response(404)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+            self.send_headers(403)
 
-    def do_PUT(self): #pylint:disable=invalid-name
-        parts = self.path.split("?")
-        path = parts[0]
-        query = urllib.parse.parse_qs(parts[1]) if len(parts) > 1 else None
-
-        match = PUT_BLOB_MATCHER.match(path)
-        if match:
-            filename = match.group(1)
-            content_len = int(self.headers.get('content-length', 0))
-            body = self.rfile.read(content_len)
-            with open(os.path.join(BLOB_DIR, "{}.bin".format(filename)), "wb") as f:
-                f.write(body)
-            self.send_response(204)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-        else:
-            self.send_response(404)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+    def post_user(self, query):
+        data = self.read_json_body()
+        try:
+            new_user = storage.append_user(data)
+            response_body = {
+                "verificationCode": "music pear battery t-shirt",
+                "user": {
+                    "id": new_user["id"],
+                    "name": new_user["name"],
+                    "email": new_user["email"],
+                    "picture": new_user["picture"],
+                    "encryptionPubkey": new_user["encryptionPubkey"],
+                }
+            }
+            self.send_json(200, response_body)
+        except storage.UserAlreadyExists:
+            self.send_headers(409)
 
-    def do_OPTIONS(self): #pylint:disable=invalid-name
-        # required for pre-flight requests Cross-Origin Resource Sharing (CORS)
-        self.send_response(204)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-        self.end_headers()
+    def post_conversation(self, query):
+        data = self.read_json_body()
+        conversation = data["conversation"]
+        permissions = data["permissions"]
+        storage.create_messages_file(conversation["id"])
+        storage.append_conversation(conversation)
+        for permission in permissions:
+            storage.append_conversation_permission(permission)
+        self.send_headers(204)
+
+    def post_device(self, query):
+        data = self.read_json_body()
+        new_device = storage.append_device(data["device"])
+        auth.invalidate_device(new_device["id"])
+        self.send_json(200, new_device)
+
+    def post_ws_url(self, query):
+        user_id = self.authenticated_user_id()
+        if user_id is None:
+            self.send_headers(401)
+            return
+        url = "ws://localhost:8765/chat_socket?authenticated_user_id={}".format(
+            user_id
+        )
+        out = {
+            "socketUrl": url
+        }
+        self.send_json(201, out)
+
+    def put_blob(self, query, blob_id):
+        content_len = int(self.headers.get('content-length', 0))
+        try:
+            content_hash = blobstore.store_blob(blob_id, self.rfile, content_len)
+        except ConnectionError:
+            self.close_connection = True
+            return
+        self.send_headers(204, [
+            ('Access-Control-Expose-Headers', 'ETag'),
+            ('ETag', blob_etag(content_hash, None)),
+        ])
 
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
+    # listen() backlog, the default of 5 drops connection attempts of a few
+    # concurrent clients, which then retry only after a second
+    request_queue_size = 128
 
 def run():
-    server_address = ('', 8000)
+    server_address = (HOST, PORT)
     print("Starting server at {}:{}".format(server_address[0], server_address[1]))
     httpd = ThreadedHTTPServer(server_address, MyRequestHandler)
     httpd.serve_forever()
 
+def run_asyncio():
+    print("Starting asyncio server at {}:{}".format(HOST, PORT))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_http.serve(MyRequestHandler, HOST, PORT))
+    loop.run_forever()
+
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Kullo chat dummy REST server")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="one thread per connection or asyncio with HTTP keep-alive")
+    async_http.add_arguments(parser)
+    auth.add_arguments(parser)
+    serialization.add_arguments(parser, frames=False)
+    storage.add_arguments(parser)
+    args = parser.parse_args()
+    async_http.configure(args)
+    auth.configure(args)
+    serialization.configure(args)
+    storage.configure(args)
+    if args.mode == "asyncio":
+        run_asyncio()
+    else:
+        run()
@@ -0,0 +1,54 @@
+#pylint:disable=missing-docstring,invalid-name
+import json
+import random
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Responses and events are serialized without whitespace by default. orjson
+# is used for compact output when it is installed.
+PRETTY = False
+FAST_ENCODER = orjson is not None
+
+# Fraction of frames that get logged, 0 disables frame logging
+FRAME_LOG_SAMPLE_RATE = 0.0
+
+def dumps_bytes(obj):
+    if PRETTY:
+        return json.dumps(obj, indent=2).encode()
+    if FAST_ENCODER:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+def dumps(obj):
+    return dumps_bytes(obj).decode()
+
+def dumps_msgpack(obj):
+    """MessagePack encoding for clients that negotiated it, requires msgpack"""
+    return msgpack.packb(obj, use_bin_type=True)
+
+def log_frame(prefix, frame):
+    if FRAME_LOG_SAMPLE_RATE and random.random() < FRAME_LOG_SAMPLE_RATE:
+        print("{} {}".format(prefix, frame))
+
+def add_arguments(parser, frames=True):
+    parser.add_argument("--pretty", action="store_true",
+                        help="pretty-print JSON responses")
+    parser.add_argument("--no-fast-encoder", action="store_true",
+                        help="do not use orjson even if it is installed")
+    if frames:
+        parser.add_argument("--log-frames", type=float, default=FRAME_LOG_SAMPLE_RATE, metavar="RATE",
+                            help="fraction of sent and received frames to log (0-1)")
+
+def configure(args):
+    global PRETTY, FAST_ENCODER, FRAME_LOG_SAMPLE_RATE
+    PRETTY = args.pretty
+    FAST_ENCODER = FAST_ENCODER and not args.no_fast_encoder
+    FRAME_LOG_SAMPLE_RATE = getattr(args, "log_frames", FRAME_LOG_SAMPLE_RATE)
@@ -1,119 +1,1045 @@
 #pylint:disable=missing-docstring,invalid-name
+import bisect
+import concurrent.futures
+import contextlib
 import copy
 import datetime
+import fcntl
+import functools
+import gc
+import gzip
+import hashlib
 import json
 import os
+import pickle
+import stat
+import struct
+import tempfile
+import threading
+import time
+import types
+
+import metrics
 
 DATABASE_DIR = "database_dir"
+DATABASE_FILE_BLOBS = os.path.join(DATABASE_DIR, "blobs.jsonl")
+DATABASE_FILE_BLOBS_LEGACY = os.path.join(DATABASE_DIR, "blobs.json")
 DATABASE_FILE_CONVERSATIONS = os.path.join(DATABASE_DIR, "conversations.json")
 DATABASE_FILE_CONVERSATION_PERMISSIONS = os.path.join(DATABASE_DIR, "conversation_permissions.json")
 DATABASE_FILE_DEVICES = os.path.join(DATABASE_DIR, "devices.json")
-DATABASE_FILE_MESSAGES = os.path.join(DATABASE_DIR, "messages_{}.json")
+DATABASE_FILE_MESSAGES = os.path.join(DATABASE_DIR, "messages_{}.jsonl")
+DATABASE_FILE_MESSAGES_INDEX = os.path.join(DATABASE_DIR, "messages_{}.idx")
+DATABASE_FILE_MESSAGES_LEGACY = os.path.join(DATABASE_DIR, "messages_{}.json")
+DATABASE_FILE_MESSAGES_SEGMENTS = os.path.join(DATABASE_DIR, "messages_{}.segments")
+DATABASE_FILE_MESSAGES_SEGMENT = os.path.join(DATABASE_DIR, "messages_{}.{:010d}.gz")
 DATABASE_FILE_USERS = os.path.join(DATABASE_DIR, "users.json")
 
+# Seconds for which message appends are collected to be written together,
+# 0 writes every message on its own
+BATCH_WINDOW = 0.0
+BATCH_MAX_MESSAGES = 100
+# fsync() written data before reporting success
+DURABLE_WRITES = False
+
+# The functions decorated with @_api make up the storage API. They are
+# implemented here on top of JSON files. When another backend is configured
+# (see configure()), calls are forwarded to the method of the same name of
+# the backend object, e.g. storage_sqlite.SqliteBackend.
+
+BACKENDS = ("json", "sqlite")
+SQLITE_FILE = os.path.join(DATABASE_DIR, "database.sqlite3")
+
+_BACKEND = None
+
+def _api(function):
+    """Forwards calls to the configured backend and records their duration"""
+    name = function.__name__
+
+    @functools.wraps(function)
+    def dispatch(*args, **kwargs):
+        if _BACKEND is not None:
+            return getattr(_BACKEND, name)(*args, **kwargs)
+        return function(*args, **kwargs)
+    return metrics.timed(metrics.STORAGE_OPERATION_SECONDS, (name,))(dispatch)
+
 class WrongPreviousMessageIdInContext(Exception):
     pass
 
 class UserAlreadyExists(Exception):
     pass
 
-def create_messages_file(conversation_id):
-    with open(DATABASE_FILE_MESSAGES.format(conversation_id), "w") as f:
-        doc = []
-        f.write(json.dumps(doc, indent=2))
-        f.flush()
+# All modifications of a database file happen while holding an exclusive lock
+# on a lock file next to it. flock() locks belong to an open file description,
+# so they serialize threads of one process as well as the REST and websocket
+# server processes. Whole-file documents are replaced atomically by renaming a
+# temporary file, so readers never see partially written data and don't need
+# to lock. Readers of files that are modified in place take a shared lock,
+# which only excludes writers.
 
-def get_latest_message(conversation_id):
-    with open(DATABASE_FILE_MESSAGES.format(conversation_id), "r") as f:
+_HELD_LOCKS = threading.local()
+
+@contextlib.contextmanager
+def locked(path, shared=False):
+    held = _HELD_LOCKS.__dict__.setdefault("paths", {}) # path -> shared
+    if path in held:
+        # reentrant use within one thread
+        if held[path] and not shared:
+            raise RuntimeError("Exclusive lock of {} requested while holding a shared one".format(path))
+        yield
+        return
+
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        held[path] = shared
+        try:
+            yield
+        finally:
+            del held[path]
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def replace_file(path, data):
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=filename + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            metrics.STORAGE_BYTES_WRITTEN.inc(len(data), ("document",))
+            if DURABLE_WRITES:
+                os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# The database files are cached in memory after the first read. A cached
+# document is served as long as inode, mtime and size of its file are
+# unchanged, so writes by other processes are picked up on the next access.
+# Cached documents are shared, callers must not modify them.
+#
+# Together with each document, the secondary indexes defined in _INDEXERS are
+# cached. They are rebuilt whenever the document is (re)loaded or written.
+
+_CACHE = {}
+_CACHE_LOCK = threading.RLock()
+CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "snapshotLoads": 0,
+}
+
+def index_conversations(doc):
+    conversation_ids = {}
+    for c in doc:
+        for participant_id in c["participantIds"]:
+            conversation_ids.setdefault(participant_id, set()).add(c["id"])
+    return {
+        "id": {c["id"]: c for c in doc},
+        "participantIdToConversationIds": conversation_ids,
+    }
+
+def index_conversation_permissions(doc):
+    owner_ids = {}
+    conversation_ids = {}
+    owned_permissions = {}
+    for p in doc:
+        owner_ids.setdefault(p["conversationId"], set()).add(p["ownerId"])
+        conversation_ids.setdefault(p["ownerId"], set()).add(p["conversationId"])
+        owned_permissions.setdefault(p["ownerId"], []).append(p)
+    return {
+        "conversationIdToOwnerIds": owner_ids,
+        "ownerIdToConversationIds": conversation_ids,
+        "ownerId": owned_permissions,
+        "conversationKeyId": {p["conversationKeyId"]: p["conversationId"] for p in doc},
+        "ownerIdAndConversationKeyId": {(p["ownerId"], p["conversationKeyId"]): p for p in doc},
+    }
+
+def index_users(doc):
+    return {
+        "id": {u["id"]: u for u in doc},
+        "sortedIds": sorted(u["id"] for u in doc),
+        "email": {u["email"]: u for u in doc},
+        "loginKey": {u["loginKey"]: u for u in doc if "loginKey" in u},
+    }
+
+_INDEXERS = {
+    DATABASE_FILE_CONVERSATIONS: index_conversations,
+    DATABASE_FILE_CONVERSATION_PERMISSIONS: index_conversation_permissions,
+    DATABASE_FILE_USERS: index_users,
+}
+
+def file_signature(path_or_fd):
+    stat_result = os.stat(path_or_fd)
+    return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+def cache_document(path, signature, doc):
+    indexer = _INDEXERS.get(path)
+    indexes = indexer(doc) if indexer else {}
+    _CACHE[path] = (signature, doc, indexes)
+
+def load_cached(path):
+    with _CACHE_LOCK:
+        signature = file_signature(path)
+        cached = _CACHE.get(path)
+        if cached and cached[0] == signature:
+            CACHE_STATS["hits"] += 1
+            return cached
+
+        CACHE_STATS["misses"] += 1
+        # many small objects are created, without any garbage among them
+        with paused_gc():
+            if load_snapshot(path, signature):
+                CACHE_STATS["snapshotLoads"] += 1
+                return _CACHE[path]
+            with open(path, "r") as f:
+                # the file may have been replaced since the stat() above
+                signature = file_signature(f.fileno())
+                doc = json.load(f)
+            cache_document(path, signature, doc)
+        schedule_snapshot(path, signature)
+        return _CACHE[path]
+
+def load_document(path):
+    return load_cached(path)[1]
+
+def load_index(path, name):
+    return load_cached(path)[2][name]
+
+def write_document(path, doc, **dumps_args):
+    """Must be called while holding the lock of `path`"""
+    replace_file(path, json.dumps(doc, indent=2, **dumps_args).encode())
+    with _CACHE_LOCK:
+        signature = file_signature(path)
+        cache_document(path, signature, doc)
+    schedule_snapshot(path, signature)
+
+@contextlib.contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# Large documents are saved together with their indexes to a snapshot file
+# next to them, so that a restarted server loads them without parsing and
+# indexing again. A snapshot is only used if the signature of the document
+# file is unchanged and the indexes were built by the current indexer code.
+# Otherwise the document is loaded as usual and a new snapshot is written in
+# the background, at most every SNAPSHOT_INTERVAL seconds per document.
+#
+# Message logs need no snapshot, their index files make reading the latest
+# messages a constant time operation regardless of the history size.
+
+SNAPSHOT_FILE = "{}.snapshot"
+SNAPSHOT_INTERVAL = 30.0 # seconds, 0 disables snapshots
+SNAPSHOT_MIN_SIZE = 1024 * 1024 # bytes, smaller documents are parsed quickly
+SNAPSHOT_FORMAT = 1
+
+_SNAPSHOT_PENDING = {} # path -> signature of the cached document
+_SNAPSHOT_CONDITION = threading.Condition()
+_SNAPSHOT_WRITER = None
+
+def code_fingerprint(code):
+    digest = hashlib.sha256(code.co_code + repr(code.co_names).encode())
+    for const in code.co_consts:
+        # nested functions and comprehensions
+        digest.update(code_fingerprint(const).encode() if isinstance(const, types.CodeType) else repr(const).encode())
+    return digest.hexdigest()
+
+def indexer_fingerprint(path):
+    indexer = _INDEXERS.get(path)
+    return code_fingerprint(indexer.__code__) if indexer else None
+
+def load_snapshot(path, signature):
+    """Caches the document from its snapshot if it is up to date, must be
+    called while holding _CACHE_LOCK"""
+    if not SNAPSHOT_INTERVAL:
+        return False
+    try:
+        with open(SNAPSHOT_FILE.format(path), "rb") as f:
+            snapshot_format, snapshot_signature, fingerprint, doc, indexes = pickle.load(f)
+    except FileNotFoundError:
+        return False
+    except (pickle.UnpicklingError, EOFError, ValueError, TypeError) as e:
+        print("Ignoring unreadable snapshot of {}: {}".format(path, e))
+        return False
+    if (snapshot_format, snapshot_signature, fingerprint) != (SNAPSHOT_FORMAT, signature, indexer_fingerprint(path)):
+        return False
+    _CACHE[path] = (signature, doc, indexes)
+    return True
+
+def schedule_snapshot(path, signature):
+    global _SNAPSHOT_WRITER
+    if not SNAPSHOT_INTERVAL or signature[2] < SNAPSHOT_MIN_SIZE:
+        return
+    with _SNAPSHOT_CONDITION:
+        _SNAPSHOT_PENDING[path] = signature
+        if _SNAPSHOT_WRITER is None:
+            _SNAPSHOT_WRITER = threading.Thread(target=write_snapshots, name="snapshot-writer", daemon=True)
+            _SNAPSHOT_WRITER.start()
+        _SNAPSHOT_CONDITION.notify()
+
+def write_snapshots():
+    while True:
+        with _SNAPSHOT_CONDITION:
+            while not _SNAPSHOT_PENDING:
+                _SNAPSHOT_CONDITION.wait()
+        # collects further changes of the documents meanwhile
+        time.sleep(SNAPSHOT_INTERVAL)
+        with _SNAPSHOT_CONDITION:
+            pending = dict(_SNAPSHOT_PENDING)
+            _SNAPSHOT_PENDING.clear()
+        for path in pending:
+            with _CACHE_LOCK:
+                signature, doc, indexes = _CACHE[path]
+            # cached documents are never modified, so pickling outside the lock is safe
+            data = pickle.dumps(
+                (SNAPSHOT_FORMAT, signature, indexer_fingerprint(path), doc, indexes),
+                protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                replace_file(SNAPSHOT_FILE.format(path), data)
+            except OSError as e:
+                print("Could not write snapshot of {}: {}".format(path, e))
+
+# Messages are stored as an append-only log with one JSON document per line,
+# so that posting a message costs O(1) I/O regardless of the conversation size.
+# Message IDs are contiguous starting at 1. The index file next to the log
+# stores the byte offset of the N-th line of the log as the N-th fixed size
+# entry, which makes seeking to any message ID a constant time operation.
+#
+# Appends are done under the lock of the log file. A line without terminating
+# line break is the remainder of an interrupted write: readers ignore it and
+# the next append removes it.
+#
+# Older messages are moved out of the log into sealed segments, see below. The
+# log then starts with the message following the last sealed one.
+
+TAIL_READ_CHUNK_SIZE = 4096
+INDEX_ENTRY = struct.Struct(">Q")
+
+def messages_file(conversation_id):
+    path = DATABASE_FILE_MESSAGES.format(conversation_id)
+    if not os.path.exists(path):
+        legacy_path = DATABASE_FILE_MESSAGES_LEGACY.format(conversation_id)
+        if os.path.exists(legacy_path):
+            with locked(path):
+                if os.path.exists(legacy_path):
+                    convert_legacy_messages_file(legacy_path, path)
+    return path
+
+def convert_legacy_messages_file(legacy_path, path):
+    with open(legacy_path, "r") as f:
         doc = json.load(f)
-        if doc:
-            return doc[-1]
+    replace_file(path, "".join(json.dumps(message) + "\n" for message in doc).encode())
+    os.remove(legacy_path)
+
+def read_last_line(f):
+    """Returns the last complete line of a file or b"" if there is none"""
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    tail = b""
+    while position > 0:
+        step = min(TAIL_READ_CHUNK_SIZE, position)
+        position -= step
+        f.seek(position)
+        tail = f.read(step) + tail
+        end = tail.rfind(b"\n")
+        if end != -1:
+            start = tail.rfind(b"\n", 0, end)
+            if start != -1:
+                return tail[start + 1:end + 1]
+    end = tail.rfind(b"\n")
+    return tail[:end + 1]
+
+def discard_incomplete_last_line(f):
+    end = f.seek(0, os.SEEK_END)
+    position = end
+    while position > 0:
+        step = min(TAIL_READ_CHUNK_SIZE, position)
+        position -= step
+        f.seek(position)
+        newline_index = f.read(step).rfind(b"\n")
+        if newline_index != -1:
+            position += newline_index + 1
+            break
+    if position != end:
+        f.truncate(position)
+
+@_api
+def create_messages_file(conversation_id):
+    """Creates an empty message log, dropping any previous history"""
+    path = DATABASE_FILE_MESSAGES.format(conversation_id)
+    with locked(path):
+        # index first, an empty index is valid for any log
+        with open(DATABASE_FILE_MESSAGES_INDEX.format(conversation_id), "wb") as f:
+            f.flush()
+        with open(path, "wb") as f:
+            f.flush()
+        remove_segments(conversation_id)
+
+def starts_complete_line(log, offset):
+    """Whether a complete line of the log starts at `offset`. Leaves the log
+    positioned after that line."""
+    if offset > 0:
+        log.seek(offset - 1)
+        if log.read(1) != b"\n":
+            return False
+    else:
+        log.seek(0)
+    return log.readline().endswith(b"\n")
+
+def update_log_index(path, index_path):
+    """Indexes log lines not covered by the index yet, returns the line count."""
+    with locked(path), open(path, "rb") as log, open(index_path, "a+b") as index:
+        index.seek(0, os.SEEK_END)
+        count = index.tell() // INDEX_ENTRY.size
+        if index.tell() % INDEX_ENTRY.size:
+            index.truncate(count * INDEX_ENTRY.size)
+
+        if count:
+            index.seek((count - 1) * INDEX_ENTRY.size)
+            if not starts_complete_line(log, INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]):
+                # the log lost lines the index refers to, e.g. in a crash
+                print("Rebuilding index {} of {}".format(index_path, path))
+                index.truncate(0)
+                count = 0
+                log.seek(0)
+
+        new_entries = []
+        offset = log.tell()
+        for line in log:
+            if not line.endswith(b"\n"):
+                break
+            new_entries.append(INDEX_ENTRY.pack(offset))
+            offset += len(line)
+
+        if new_entries:
+            index.write(b"".join(new_entries))
+            index.flush()
+            metrics.STORAGE_BYTES_WRITTEN.inc(len(new_entries) * INDEX_ENTRY.size, ("index",))
+        return count + len(new_entries)
+
+def append_log_lines(f, index_path, lines, kind):
+    """Appends complete lines to an indexed log opened for appending"""
+    offset = f.seek(0, os.SEEK_END)
+    index_entries = []
+    for line in lines:
+        index_entries.append(INDEX_ENTRY.pack(offset))
+        offset += len(line)
+
+    data = b"".join(lines)
+    f.write(data)
+    f.flush()
+    metrics.STORAGE_BYTES_WRITTEN.inc(len(data), (kind,))
+    if DURABLE_WRITES:
+        os.fsync(f.fileno())
+    with open(index_path, "ab") as index:
+        index.write(b"".join(index_entries))
+        index.flush()
+        metrics.STORAGE_BYTES_WRITTEN.inc(len(index_entries) * INDEX_ENTRY.size, ("index",))
+        if DURABLE_WRITES:
+            os.fsync(index.fileno())
+
+def indexed_line_count(path, index_path):
+    """Returns the line count of a log if its index covers all complete lines,
+    otherwise None. Doesn't write, so a shared lock of the log is enough."""
+    try:
+        with open(index_path, "rb") as index, open(path, "rb") as log:
+            size = index.seek(0, os.SEEK_END)
+            if size % INDEX_ENTRY.size:
+                return None
+            count = size // INDEX_ENTRY.size
+            if count:
+                index.seek(size - INDEX_ENTRY.size)
+                if not starts_complete_line(log, INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]):
+                    return None
+            # at most the remainder of an interrupted write follows
+            if b"\n" in log.read():
+                return None
+            return count
+    except FileNotFoundError:
+        return None
+
+def read_log_entries(path, index_path, first, count):
+    """Returns `count` entries starting at the `first` (0-based) line of an indexed log"""
+    if count <= 0:
+        return []
+    with open(index_path, "rb") as index:
+        index.seek(first * INDEX_ENTRY.size)
+        first_offset = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+
+    with open(path, "rb") as log:
+        log.seek(first_offset)
+        return [json.loads(log.readline().decode()) for _ in range(count)]
+
+# Long histories are split into segments. When the log has reached
+# SEGMENT_MAX_MESSAGES messages or SEGMENT_MAX_BYTES, the next append seals
+# its content into an immutable gzip compressed segment and starts over with
+# an empty log. The first line of a segment is a header with its ID range, the
+# ranges of all segments of a conversation are listed in a small document next
+# to the log. Reading a page only decompresses the segments covering it, and
+# recently read segments are kept decompressed in memory.
+#
+# A segment is complete before it is listed and listed before the log is
+# emptied. If sealing is interrupted in between, the messages are in both the
+# segment and the log, which is emptied by the next append.
+
+SEGMENT_MAX_MESSAGES = 5000 # 0: no limit
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024 # 0: no limit
+SEGMENT_CACHE_SIZE = 16 # decompressed segments kept in memory
+SEGMENT_COMPRESSION_LEVEL = 6
+
+def messages_segments(conversation_id):
+    """List of {"firstId", "lastId"} of the sealed segments in ID order"""
+    path = DATABASE_FILE_MESSAGES_SEGMENTS.format(conversation_id)
+    if not os.path.exists(path):
+        return []
+    return load_document(path)
+
+def messages_log_base(log, segments):
+    """ID of the message preceding the first one in the log opened at its start"""
+    first_line = log.readline()
+    if first_line.endswith(b"\n"):
+        return json.loads(first_line.decode())["id"] - 1
+    return segments[-1]["lastId"] if segments else 0
+
+def read_segment(path):
+    """Returns header and message lines of a sealed segment"""
+    return read_segment_file(path, file_signature(path))
+
+@functools.lru_cache(maxsize=SEGMENT_CACHE_SIZE)
+def read_segment_file(path, signature):
+    # the signature tells apart segments of a history that has been recreated
+    with gzip.open(path, "rb") as f:
+        header = json.loads(f.readline().decode())
+        return header, f.read().splitlines()
+
+def read_sealed_messages(conversation_id, segments, first_id, last_id):
+    """Returns the messages `first_id` to `last_id` from the segments"""
+    position = bisect.bisect_right([s["firstId"] for s in segments], first_id) - 1
+    messages = []
+    while first_id <= last_id:
+        segment = segments[position]
+        _, lines = read_segment(DATABASE_FILE_MESSAGES_SEGMENT.format(conversation_id, segment["firstId"]))
+        end_id = min(last_id, segment["lastId"])
+        messages.extend(
+            json.loads(line.decode())
+            for line in lines[first_id - segment["firstId"]:end_id - segment["firstId"] + 1])
+        first_id = end_id + 1
+        position += 1
+    return messages
+
+def seal_messages_log(conversation_id):
+    """Moves the content of the log into a new segment if the log has reached
+    the segment limits. Must be called while holding the lock of the log."""
+    path = messages_file(conversation_id)
+    index_path = DATABASE_FILE_MESSAGES_INDEX.format(conversation_id)
+    count = update_log_index(path, index_path)
+    if not count:
+        return
+
+    segments = messages_segments(conversation_id)
+    with open(path, "rb") as log:
+        first_id = json.loads(log.readline().decode())["id"]
+        if segments and segments[-1]["lastId"] >= first_id:
+            print("Completing interrupted sealing of {}".format(path))
         else:
-            return None
+            size = log.seek(0, os.SEEK_END)
+            if not ((SEGMENT_MAX_MESSAGES and count >= SEGMENT_MAX_MESSAGES)
+                    or (SEGMENT_MAX_BYTES and size >= SEGMENT_MAX_BYTES)):
+                return
+            log.seek(0)
+            lines = [line for line in log if line.endswith(b"\n")]
+            segment = {"firstId": first_id, "lastId": first_id + len(lines) - 1}
+            header = json.dumps(segment).encode() + b"\n"
+            replace_file(
+                DATABASE_FILE_MESSAGES_SEGMENT.format(conversation_id, first_id),
+                gzip.compress(header + b"".join(lines), SEGMENT_COMPRESSION_LEVEL))
+            segments_path = DATABASE_FILE_MESSAGES_SEGMENTS.format(conversation_id)
+            with locked(segments_path):
+                write_document(segments_path, segments + [segment])
+
+    replace_file(index_path, b"")
+    replace_file(path, b"")
+
+def remove_segments(conversation_id):
+    """Removes all sealed segments. Must be called while holding the lock of
+    the log."""
+    segments_path = DATABASE_FILE_MESSAGES_SEGMENTS.format(conversation_id)
+    with locked(segments_path):
+        segments = messages_segments(conversation_id)
+        # unlisted first, so that no reader looks for the removed files
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(segments_path)
+        for segment in segments:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(DATABASE_FILE_MESSAGES_SEGMENT.format(conversation_id, segment["firstId"]))
+    read_segment_file.cache_clear()
+
+@_api
+def update_messages_index(conversation_id):
+    """Indexes log lines not covered by the index yet, returns the message count."""
+    path = messages_file(conversation_id)
+    with locked(path):
+        with open(path, "rb") as log:
+            base = messages_log_base(log, messages_segments(conversation_id))
+        return base + update_log_index(path, DATABASE_FILE_MESSAGES_INDEX.format(conversation_id))
+
+def existing_messages_file(conversation_id):
+    """Like messages_file(), raises FileNotFoundError for unknown
+    conversations, before anything is created for them"""
+    path = messages_file(conversation_id)
+    if not os.path.exists(path):
+        raise FileNotFoundError("No messages for conversation {}".format(conversation_id))
+    return path
+
+@_api
+def get_messages_page(conversation_id, before_id, limit):
+    """Returns up to `limit` messages with IDs lower than `before_id` (all if None)
+    in ascending order and whether there are older messages."""
+    path = existing_messages_file(conversation_id)
+    index_path = DATABASE_FILE_MESSAGES_INDEX.format(conversation_id)
+    for _ in range(2):
+        # the lock keeps the log from being appended to or sealed while reading
+        with locked(path, shared=True):
+            segments = messages_segments(conversation_id)
+            with open(path, "rb") as log:
+                base = messages_log_base(log, segments)
+            log_count = indexed_line_count(path, index_path)
+            if log_count is not None:
+                count = base + log_count
+                upper_id = count if before_id is None else min(before_id - 1, count)
+                lower_id = max(upper_id - limit, 0)
+                if upper_id <= 0:
+                    return [], False
+
+                first_log_id = max(lower_id, base)
+                messages = read_log_entries(path, index_path, first_log_id - base, upper_id - first_log_id)
+                if lower_id < base:
+                    messages = read_sealed_messages(
+                        conversation_id, segments, lower_id + 1, min(upper_id, base)) + messages
+                return messages, lower_id > 0
+        # index the lines of an interrupted append or rebuild a broken index
+        # under the exclusive lock, then read once more
+        update_messages_index(conversation_id)
+    raise RuntimeError("Index of {} does not match the log".format(path))
 
+@_api
+def get_latest_message(conversation_id):
+    with open(messages_file(conversation_id), "rb") as f:
+        line = read_last_line(f)
+    if line.strip():
+        return json.loads(line.decode())
+    # the log is emptied after the segment has been listed
+    segments = messages_segments(conversation_id)
+    if segments:
+        _, lines = read_segment(DATABASE_FILE_MESSAGES_SEGMENT.format(conversation_id, segments[-1]["firstId"]))
+        return json.loads(lines[-1].decode())
+    return None
+
+@_api
 def get_all_messages(conversation_id):
-    with open(DATABASE_FILE_MESSAGES.format(conversation_id), "r") as f:
-        doc = json.load(f)
-        return doc
+    path = existing_messages_file(conversation_id)
+    with locked(path, shared=True), open(path, "rb") as f:
+        segments = messages_segments(conversation_id)
+        base = messages_log_base(f, segments)
+        f.seek(0)
+        messages = [json.loads(line.decode()) for line in f if line.endswith(b"\n")]
+        if base:
+            messages = read_sealed_messages(conversation_id, segments, 1, base) + messages
+    return messages
+
+# Changes that syncing clients need are recorded in a journal, an indexed log
+# like the message logs. The sequence number of a change is its line number;
+# clients pass the last one they have seen as cursor. Message changes only
+# reference the message, which is read from its conversation's log. Changes
+# are visible to the members of their conversation, permission changes only
+# to the permission's owner.
 
+DATABASE_FILE_CHANGES = os.path.join(DATABASE_DIR, "changes.jsonl")
+DATABASE_FILE_CHANGES_INDEX = os.path.join(DATABASE_DIR, "changes.idx")
+CHANGES_SCAN_CHUNK_SIZE = 500
+
+def record_changes(changes):
+    """Appends (type, conversation ID, data) tuples to the change journal"""
+    if not changes:
+        return
+    path = DATABASE_FILE_CHANGES
+    with locked(path), open(path, "a+b") as f:
+        discard_incomplete_last_line(f)
+        seq = update_log_index(path, DATABASE_FILE_CHANGES_INDEX)
+        now = rfc3339_now()
+        lines = []
+        for change_type, conversation_id, data in changes:
+            seq += 1
+            change = {
+                "seq": seq,
+                "time": now,
+                "type": change_type,
+                "conversationId": conversation_id,
+                "data": data,
+            }
+            lines.append((json.dumps(change) + "\n").encode())
+        append_log_lines(f, DATABASE_FILE_CHANGES_INDEX, lines, "changes")
+
+def change_owner_id(change_type, data):
+    """ID of the only user who may see a change or None if all members of
+    its conversation may"""
+    if change_type == "conversation_permission.added":
+        return data["ownerId"]
+    return None
+
+def changes_count():
+    if not os.path.exists(DATABASE_FILE_CHANGES):
+        return 0
+    return update_log_index(DATABASE_FILE_CHANGES, DATABASE_FILE_CHANGES_INDEX)
+
+def resolve_message_changes(changes):
+    """Returns the changes with the message references of message.added
+    changes replaced by the messages. Changes of messages that no longer
+    exist, because the conversation's history has been reset, are left out."""
+    messages = {}
+    for conversation_id, ids in referenced_message_ids(changes).items():
+        first_id, last_id = min(ids), max(ids)
+        try:
+            page, _ = get_messages_page(conversation_id, last_id + 1, last_id - first_id + 1)
+        except FileNotFoundError:
+            continue
+        for message in page:
+            messages[(conversation_id, message["id"])] = message
+    return replace_message_references(changes, messages)
+
+def referenced_message_ids(changes):
+    """Dict conversation ID -> IDs of the messages of message.added changes"""
+    message_ids = {}
+    for change in changes:
+        if change["type"] == "message.added":
+            message_ids.setdefault(change["conversationId"], []).append(change["data"]["id"])
+    return message_ids
+
+def replace_message_references(changes, messages):
+    """Returns the changes with message references replaced by the messages
+    of the dict (conversation ID, message ID) -> message, leaving out
+    changes of messages not in the dict"""
+    resolved = []
+    for change in changes:
+        if change["type"] == "message.added":
+            message = messages.get((change["conversationId"], change["data"]["id"]))
+            if message is None:
+                continue
+            change["data"] = message
+        resolved.append(change)
+    return resolved
+
+@_api
+def get_latest_changes_cursor():
+    return changes_count()
+
+@_api
+def get_changes_cursor_at(rfc3339_time):
+    """Sequence number of the last change recorded at or before a time in
+    the format of rfc3339_now()"""
+    low, high = 0, changes_count()
+    while low < high:
+        middle = (low + high) // 2
+        change = read_log_entries(DATABASE_FILE_CHANGES, DATABASE_FILE_CHANGES_INDEX, middle, 1)[0]
+        if change["time"] <= rfc3339_time:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+@_api
+def get_changes(user_id, cursor, limit):
+    """Returns up to `limit` changes after the `cursor` sequence number in
+    conversations of the user, the cursor to continue from and whether more
+    changes may be available. Like get_user_conversation_permissions(), only
+    the user's own permissions are included."""
+    count = changes_count()
+    conversation_ids = get_user_conversation_ids(user_id)
+    changes = []
+    while cursor < count and len(changes) < limit:
+        chunk = read_log_entries(
+            DATABASE_FILE_CHANGES, DATABASE_FILE_CHANGES_INDEX,
+            cursor, min(CHANGES_SCAN_CHUNK_SIZE, count - cursor))
+        for change in chunk:
+            cursor = change["seq"]
+            owner_id = change_owner_id(change["type"], change["data"])
+            if change["conversationId"] in conversation_ids and owner_id in (None, user_id):
+                changes.append(change)
+                if len(changes) == limit:
+                    break
+    return resolve_message_changes(changes), cursor, cursor < count
+
+def sync_changes(user_id, cursor, since, limit):
+    """Changes for a syncing client after `cursor` or, if that is None, after
+    the RFC 3339 time `since`. Without both, no changes but the current
+    cursor are returned. Raises ValueError for an invalid time."""
+    if cursor is None and since is None:
+        return [], get_latest_changes_cursor(), False
+    if cursor is None:
+        since_time = datetime.datetime.fromisoformat(since)
+        if since_time.tzinfo is None:
+            raise ValueError("Time without time zone: {}".format(since))
+        utc_time = since_time.astimezone(datetime.timezone.utc).isoformat(timespec='milliseconds')
+        cursor = get_changes_cursor_at(utc_time)
+    return get_changes(user_id, cursor, limit)
+
+@_api
 def get_all_conversation_permissions():
-    with open(DATABASE_FILE_CONVERSATION_PERMISSIONS, "r") as f:
-        doc = json.load(f)
-        return doc
+    return load_document(DATABASE_FILE_CONVERSATION_PERMISSIONS)
+
+@_api
+def get_conversation_permission(owner_id, conversation_key_id):
+    index = load_index(DATABASE_FILE_CONVERSATION_PERMISSIONS, "ownerIdAndConversationKeyId")
+    permission = index.get((owner_id, conversation_key_id))
+    return copy.deepcopy(permission) if permission else None
+
+@_api
+def get_conversation_permissions(owner_id, conversation_key_ids):
+    """Dict conversation key ID -> permission for the given key IDs that have
+    a permission for the owner"""
+    index = load_index(DATABASE_FILE_CONVERSATION_PERMISSIONS, "ownerIdAndConversationKeyId")
+    permissions = {}
+    for conversation_key_id in conversation_key_ids:
+        permission = index.get((owner_id, conversation_key_id))
+        if permission:
+            permissions[conversation_key_id] = copy.deepcopy(permission)
+    return permissions
 
+@_api
+def get_conversation_id_by_key_id(conversation_key_id):
+    """Raises KeyError if no permission for the given key ID exists."""
+    index = load_index(DATABASE_FILE_CONVERSATION_PERMISSIONS, "conversationKeyId")
+    return index[conversation_key_id]
+
+@_api
+def get_conversation_member_ids(conversation_id):
+    """IDs of all users owning a permission for or participating in a conversation"""
+    owner_ids = load_index(DATABASE_FILE_CONVERSATION_PERMISSIONS, "conversationIdToOwnerIds")
+    member_ids = set(owner_ids.get(conversation_id, ()))
+    conversation = load_index(DATABASE_FILE_CONVERSATIONS, "id").get(conversation_id)
+    if conversation:
+        member_ids.update(conversation["participantIds"])
+    return member_ids
+
+@_api
+def get_user_conversation_ids(user_id):
+    """IDs of all conversations the user owns a permission for or participates in"""
+    owned = load_index(DATABASE_FILE_CONVERSATION_PERMISSIONS, "ownerIdToConversationIds")
+    participating = load_index(DATABASE_FILE_CONVERSATIONS, "participantIdToConversationIds")
+    conversation_ids = set(owned.get(user_id, ()))
+    conversation_ids.update(participating.get(user_id, ()))
+    return conversation_ids
+
+@_api
+def get_user_conversation_permissions(user_id, conversation_ids):
+    """Permissions owned by the user for the given conversations"""
+    owned = load_index(DATABASE_FILE_CONVERSATION_PERMISSIONS, "ownerId").get(user_id, ())
+    conversation_ids = set(conversation_ids)
+    return [p for p in owned if p["conversationId"] in conversation_ids]
+
+@_api
+def get_user_conversations_page(user_id, after_id, limit):
+    """Returns up to `limit` conversations visible to the user with IDs
+    greater than `after_id` in ID order, and whether more are available"""
+    conversation_ids = sorted(get_user_conversation_ids(user_id))
+    start = bisect.bisect_right(conversation_ids, after_id) if after_id is not None else 0
+    page_ids = conversation_ids[start:start + limit]
+    conversations = load_index(DATABASE_FILE_CONVERSATIONS, "id")
+    page = [conversations[conversation_id] for conversation_id in page_ids if conversation_id in conversations]
+    return page, start + limit < len(conversation_ids)
+
+@_api
 def get_all_conversations():
-    with open(DATABASE_FILE_CONVERSATIONS, "r") as f:
-        doc = json.load(f)
-        return doc
+    return load_document(DATABASE_FILE_CONVERSATIONS)
 
+@_api
 def get_conversation(conversation_id):
-    with open(DATABASE_FILE_CONVERSATIONS, "r") as f:
-        doc = json.load(f)
-        for conversation in doc:
-            if conversation["id"] == conversation_id:
-                return conversation
-        return None
+    conversation = load_index(DATABASE_FILE_CONVERSATIONS, "id").get(conversation_id)
+    return copy.deepcopy(conversation) if conversation else None
 
+@_api
 def update_conversation(conversation):
-    with open(DATABASE_FILE_CONVERSATIONS, "r+") as f:
-        doc = json.load(f)
+    with locked(DATABASE_FILE_CONVERSATIONS):
+        doc = list(load_document(DATABASE_FILE_CONVERSATIONS))
         for index, item in enumerate(doc):
             if item["id"] == conversation["id"]:
-                doc[index] = conversation
-                f.seek(0)
-                f.truncate()
-                f.write(json.dumps(doc, indent=2, sort_keys=True))
-                f.flush()
+                doc[index] = copy.deepcopy(conversation)
+                write_document(DATABASE_FILE_CONVERSATIONS, doc, sort_keys=True)
+                record_changes([("conversation.updated", conversation["id"], conversation)])
                 return
         raise Exception("Conversation to update not found.")
 
+@_api
+def update_conversation_participants(conversation_id, action, user_id):
+    """Adds (action "join") or removes (action "leave") a participant and
+    returns the updated conversation"""
+    with locked(DATABASE_FILE_CONVERSATIONS):
+        conversation = get_conversation(conversation_id)
+        if action == "join":
+            conversation["participantIds"].append(user_id)
+        elif action == "leave":
+            conversation["participantIds"].remove(user_id)
+        update_conversation(conversation)
+        return conversation
+
+@_api
 def get_all_devices():
-    with open(DATABASE_FILE_DEVICES, "r") as f:
-        doc = json.load(f)
-        return doc
+    return load_document(DATABASE_FILE_DEVICES)
 
+@_api
 def get_device(device_id):
-    with open(DATABASE_FILE_DEVICES, "r") as f:
+    return copy.deepcopy(load_document(DATABASE_FILE_DEVICES)[device_id])
+
+@_api
+def get_devices(device_ids):
+    """Dict device ID -> device for the given IDs that exist"""
+    doc = load_document(DATABASE_FILE_DEVICES)
+    return {device_id: copy.deepcopy(doc[device_id]) for device_id in device_ids if device_id in doc}
+
+# Blob IDs are mapped to the SHA-256 hash of their content, see blobstore.py.
+# The hash is None until the content is uploaded.
+#
+# The mapping is stored as a log of {"id", "hash", "size"} records, one per
+# line, of which the last one of an ID is valid. Reserving IDs and storing
+# content appends to it, which costs O(1) I/O regardless of the number of
+# blobs. The mapping and the reference counts of the hashes are kept in
+# memory and updated from the lines appended since the last read, also by
+# other processes. A line without line break is the remainder of an
+# interrupted write, as in the message logs.
+
+_BLOBS = {"inode": None, "offset": 0, "blobs": {}, "referenceCounts": {}}
+_BLOBS_LOCK = threading.RLock()
+
+def blobs_file():
+    path = DATABASE_FILE_BLOBS
+    if not os.path.exists(path) and os.path.exists(DATABASE_FILE_BLOBS_LEGACY):
+        with locked(path):
+            if os.path.exists(DATABASE_FILE_BLOBS_LEGACY):
+                convert_legacy_blobs_file(DATABASE_FILE_BLOBS_LEGACY, path)
+    return path
+
+def convert_legacy_blobs_file(legacy_path, path):
+    with open(legacy_path, "r") as f:
         doc = json.load(f)
-        return doc[device_id]
+    replace_file(path, "".join(
+        json.dumps({"id": blob_id, "hash": blob["hash"], "size": blob["size"]}) + "\n"
+        for blob_id, blob in sorted(doc.items())).encode())
+    os.remove(legacy_path)
+
+def apply_blob_record(state, record):
+    counts = state["referenceCounts"]
+    previous = state["blobs"].get(record["id"])
+    if previous and previous["hash"]:
+        counts[previous["hash"]] -= 1
+        if not counts[previous["hash"]]:
+            del counts[previous["hash"]]
+    state["blobs"][record["id"]] = {"hash": record["hash"], "size": record["size"]}
+    if record["hash"]:
+        counts[record["hash"]] = counts.get(record["hash"], 0) + 1
+
+def load_blobs():
+    """Returns the shared dicts blob ID -> blob and content hash -> number of
+    blob IDs referencing it. Callers must not modify them."""
+    path = blobs_file()
+    with _BLOBS_LOCK:
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return {}, {}
+        state = _BLOBS
+        if stat_result.st_ino != state["inode"] or stat_result.st_size < state["offset"]:
+            # replaced or truncated, e.g. by clear_messages.sh
+            state.update(inode=stat_result.st_ino, offset=0, blobs={}, referenceCounts={})
+        if stat_result.st_size > state["offset"]:
+            with open(path, "rb") as f:
+                f.seek(state["offset"])
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    apply_blob_record(state, json.loads(line.decode()))
+                    state["offset"] += len(line)
+        return state["blobs"], state["referenceCounts"]
+
+def append_blob_records(records):
+    path = blobs_file()
+    with locked(path), open(path, "a+b") as f:
+        discard_incomplete_last_line(f)
+        data = b"".join((json.dumps(record) + "\n").encode() for record in records)
+        f.write(data)
+        f.flush()
+        metrics.STORAGE_BYTES_WRITTEN.inc(len(data), ("blobs",))
+        if DURABLE_WRITES:
+            os.fsync(f.fileno())
+
+@_api
+def get_blob(blob_id):
+    with _BLOBS_LOCK:
+        blob = load_blobs()[0].get(blob_id)
+        return dict(blob) if blob else None
+
+@_api
+def get_blob_reference_counts():
+    """Dict content hash -> number of blob IDs referencing it"""
+    with _BLOBS_LOCK:
+        return dict(load_blobs()[1])
+
+@_api
+def reserve_blob_ids(blob_ids):
+    append_blob_records([{"id": blob_id, "hash": None, "size": None} for blob_id in blob_ids])
+
+@_api
+def set_blob_content(blob_id, content_hash, size):
+    append_blob_records([{"id": blob_id, "hash": content_hash, "size": size}])
 
+@_api
 def get_all_users():
-    with open(DATABASE_FILE_USERS, "r") as f:
-        doc = json.load(f)
-        return doc
+    return load_document(DATABASE_FILE_USERS)
+
+@_api
+def get_users_page(after_id, limit):
+    """Returns up to `limit` users with IDs greater than `after_id` in ID
+    order, and whether more are available"""
+    user_ids = load_index(DATABASE_FILE_USERS, "sortedIds")
+    users = load_index(DATABASE_FILE_USERS, "id")
+    start = bisect.bisect_right(user_ids, after_id) if after_id is not None else 0
+    return [users[user_id] for user_id in user_ids[start:start + limit]], start + limit < len(user_ids)
 
+@_api
 def get_user(user_id):
-    with open(DATABASE_FILE_USERS, "r") as f:
-        doc = json.load(f)
-        for user in doc:
-            if user["id"] == user_id:
-                return user
-        return None
+    user = load_index(DATABASE_FILE_USERS, "id").get(user_id)
+    return copy.deepcopy(user) if user else None
+
+@_api
+def get_users(user_ids):
+    """Dict user ID -> user for the given IDs that exist"""
+    index = load_index(DATABASE_FILE_USERS, "id")
+    return {user_id: copy.deepcopy(index[user_id]) for user_id in user_ids if user_id in index}
 
+@_api
 def find_user(email):
-    with open(DATABASE_FILE_USERS, "r") as f:
-        doc = json.load(f)
-        for user in doc:
-            if user["email"] == email:
-                return user
-        return None
+    user = load_index(DATABASE_FILE_USERS, "email").get(email)
+    return copy.deepcopy(user) if user else None
 
+@_api
 def find_user_by_login_key(login_key):
-    with open(DATABASE_FILE_USERS, "r") as f:
-        doc = json.load(f)
-        for user in doc:
-            if user["loginKey"] == login_key:
-                return user
-        return None
+    user = load_index(DATABASE_FILE_USERS, "loginKey").get(login_key)
+    return copy.deepcopy(user) if user else None
 
+@_api
 def append_user(user):
     new_user = copy.deepcopy(user)
-    with open(DATABASE_FILE_USERS, "r+") as f:
-        doc = json.load(f)
+    with locked(DATABASE_FILE_USERS):
+        if new_user["email"] in load_index(DATABASE_FILE_USERS, "email"):
+            raise UserAlreadyExists()
 
-        for u in doc:
-            if u["email"] == new_user['email']:
-                raise UserAlreadyExists()
+        doc = list(load_document(DATABASE_FILE_USERS))
 
         if doc:
             max_id = max([u["id"] for u in doc])
@@ -125,48 +1051,37 @@ def append_user(user):
             new_user["picture"] = None
         doc.append(new_user)
 
-        f.seek(0)
-        f.truncate()
-        f.write(json.dumps(doc, indent=2, sort_keys=True))
-        f.flush()
-        return new_user
+        write_document(DATABASE_FILE_USERS, doc, sort_keys=True)
+        return copy.deepcopy(new_user)
 
+@_api
 def append_device(device):
     new_device = copy.deepcopy(device)
     new_device["state"] = "active"
-    with open(DATABASE_FILE_DEVICES, "r+") as f:
-        doc = json.load(f)
+    with locked(DATABASE_FILE_DEVICES):
+        doc = dict(load_document(DATABASE_FILE_DEVICES))
 
         device_id = device["id"]
         doc[device_id] = new_device
 
-        f.seek(0)
-        f.truncate()
-        f.write(json.dumps(doc, indent=2))
-        f.flush()
-        return new_device
+        write_document(DATABASE_FILE_DEVICES, doc)
+        return copy.deepcopy(new_device)
 
+@_api
 def append_conversation(conversation):
-    with open(DATABASE_FILE_CONVERSATIONS, "r+") as f:
-        doc = json.load(f)
-
-        doc.append(conversation)
-
-        f.seek(0)
-        f.truncate()
-        f.write(json.dumps(doc, indent=2))
-        f.flush()
+    with locked(DATABASE_FILE_CONVERSATIONS):
+        doc = list(load_document(DATABASE_FILE_CONVERSATIONS))
+        doc.append(copy.deepcopy(conversation))
+        write_document(DATABASE_FILE_CONVERSATIONS, doc)
+        record_changes([("conversation.added", conversation["id"], conversation)])
 
+@_api
 def append_conversation_permission(permission):
-    with open(DATABASE_FILE_CONVERSATION_PERMISSIONS, "r+") as f:
-        doc = json.load(f)
-
-        doc.append(permission)
-
-        f.seek(0)
-        f.truncate()
-        f.write(json.dumps(doc, indent=2))
-        f.flush()
+    with locked(DATABASE_FILE_CONVERSATION_PERMISSIONS):
+        doc = list(load_document(DATABASE_FILE_CONVERSATION_PERMISSIONS))
+        doc.append(copy.deepcopy(permission))
+        write_document(DATABASE_FILE_CONVERSATION_PERMISSIONS, doc)
+        record_changes([("conversation_permission.added", permission["conversationId"], permission)])
 
 def rfc3339_now():
     tz = datetime.timezone.utc
@@ -176,26 +1091,157 @@ def assign_id_and_time_to_server_message(server_message, identifier):
     server_message["id"] = identifier
     server_message["timeSent"] = rfc3339_now()
 
-def append_message(new_message, conversation_id):
-    with open(DATABASE_FILE_MESSAGES.format(conversation_id), "r+") as f:
-        doc = json.load(f)
+@_api
+def append_messages(new_messages, conversation_id):
+    """Appends messages in one write and returns, in order, for each message
+    either the stored message or the WrongPreviousMessageIdInContext error"""
+    path = messages_file(conversation_id)
+    with locked(path):
+        seal_messages_log(conversation_id)
+    with locked(path), open(path, "a+b") as f:
+        discard_incomplete_last_line(f)
+        update_messages_index(conversation_id)
+        line = read_last_line(f)
 
-        previous_message_id = doc[-1]["id"] if doc else 0
-        try:
-            context = new_message["context"]
-            if previous_message_id != context["previousMessageId"]:
-                raise WrongPreviousMessageIdInContext()
-        except KeyError:
-            raise WrongPreviousMessageIdInContext()
+        if line.strip():
+            previous_message_id = json.loads(line.decode())["id"]
+        else:
+            segments = messages_segments(conversation_id)
+            previous_message_id = segments[-1]["lastId"] if segments else 0
+        results = []
+        lines = []
+        for new_message in new_messages:
+            try:
+                context = new_message["context"]
+                if previous_message_id != context["previousMessageId"]:
+                    raise WrongPreviousMessageIdInContext()
+            except KeyError:
+                results.append(WrongPreviousMessageIdInContext())
+                continue
+            except WrongPreviousMessageIdInContext as e:
+                results.append(e)
+                continue
 
-        new_id = previous_message_id + 1
-        assign_id_and_time_to_server_message(new_message, new_id)
+            new_id = previous_message_id + 1
+            assign_id_and_time_to_server_message(new_message, new_id)
+            previous_message_id = new_id
 
-        doc.append(new_message)
+            lines.append((json.dumps(new_message) + "\n").encode())
+            results.append(new_message)
 
-        f.seek(0)
-        f.truncate()
-        f.write(json.dumps(doc, indent=2))
-        f.flush()
+        if lines:
+            append_log_lines(f, DATABASE_FILE_MESSAGES_INDEX.format(conversation_id), lines, "messages")
+            record_changes([
+                ("message.added", conversation_id, {"id": result["id"]})
+                for result in results
+                if not isinstance(result, Exception)
+            ])
+
+        return results
+
+class MessageBatcher:
+    """Group commit for message appends
+
+    Appends arriving within BATCH_WINDOW seconds after the first one (up to
+    BATCH_MAX_MESSAGES per conversation) are written by a background thread
+    with one append_messages() call per conversation.
+    """
+
+    def __init__(self):
+        self.pending = {} # conversation ID -> list of (message, future)
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="message-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, new_message, conversation_id):
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.pending.setdefault(conversation_id, []).append((new_message, future))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + BATCH_WINDOW
+                while max(len(p) for p in self.pending.values()) < BATCH_MAX_MESSAGES:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batches = {
+                    conversation_id: pending[:BATCH_MAX_MESSAGES]
+                    for conversation_id, pending in self.pending.items()
+                }
+                for conversation_id, pending in list(self.pending.items()):
+                    del pending[:BATCH_MAX_MESSAGES]
+                    if not pending:
+                        del self.pending[conversation_id]
+
+            for conversation_id, batch in batches.items():
+                try:
+                    results = append_messages([message for message, _ in batch], conversation_id)
+                except Exception as e: #pylint:disable=broad-except
+                    results = [e] * len(batch)
+                for (_, future), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+_BATCHER = None
+_BATCHER_LOCK = threading.Lock()
+
+def submit_message(new_message, conversation_id):
+    """Appends a message via the group commit batcher, returns a future"""
+    global _BATCHER
+    with _BATCHER_LOCK:
+        if _BATCHER is None:
+            _BATCHER = MessageBatcher()
+    return _BATCHER.submit(new_message, conversation_id)
+
+def append_message(new_message, conversation_id):
+    if BATCH_WINDOW:
+        return submit_message(new_message, conversation_id).result()
+
+    result = append_messages([new_message], conversation_id)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def add_arguments(parser):
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW * 1000, metavar="MS",
+                        help="milliseconds to collect message appends for a group commit (0: off)")
+    parser.add_argument("--batch-max-messages", type=int, default=BATCH_MAX_MESSAGES,
+                        help="maximum number of messages per group commit")
+    parser.add_argument("--durable", action="store_true",
+                        help="fsync() all writes before reporting success")
+    parser.add_argument("--backend", choices=BACKENDS, default="json",
+                        help="JSON files in {} or an SQLite database".format(DATABASE_DIR))
+    parser.add_argument("--sqlite-file", default=SQLITE_FILE,
+                        help="database file of the sqlite backend")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL,
+                        help="seconds between snapshots of changed large documents (0: no snapshots)")
+    parser.add_argument("--segment-max-messages", type=int, default=SEGMENT_MAX_MESSAGES,
+                        help="messages in a conversation's log before they are sealed into a compressed segment (0: no limit)")
+    parser.add_argument("--segment-max-bytes", type=int, default=SEGMENT_MAX_BYTES,
+                        help="log size in bytes before its messages are sealed into a compressed segment (0: no limit)")
+
+def set_backend(backend):
+    global _BACKEND
+    _BACKEND = backend
 
-        return doc[-1]
+def configure(args):
+    global BATCH_WINDOW, BATCH_MAX_MESSAGES, DURABLE_WRITES, SEGMENT_MAX_MESSAGES, SEGMENT_MAX_BYTES
+    global SNAPSHOT_INTERVAL
+    BATCH_WINDOW = args.batch_window / 1000
+    BATCH_MAX_MESSAGES = args.batch_max_messages
+    DURABLE_WRITES = args.durable
+    SEGMENT_MAX_MESSAGES = args.segment_max_messages
+    SEGMENT_MAX_BYTES = args.segment_max_bytes
+    SNAPSHOT_INTERVAL = args.snapshot_interval
+    if args.backend == "sqlite":
+        import storage_sqlite # imports this module
+        set_backend(storage_sqlite.SqliteBackend(args.sqlite_file))
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+#pylint:disable=missing-docstring,invalid-name
+"""SQLite backend of the storage module
+
+All entities live in one database file in WAL mode, so readers don't block
+the writer and the REST and websocket server processes can share it. Each
+row keeps the entity as JSON next to the columns it is looked up by.
+
+Run `storage_sqlite.py migrate` in the server's working directory to import
+the JSON files of an existing database_dir.
+"""
+
+import argparse
+import contextlib
+import copy
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+import metrics
+import storage
+
+BUSY_TIMEOUT = 10000 # milliseconds to wait for another writer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    login_key TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_login_key ON users (login_key);
+
+CREATE TABLE IF NOT EXISTS devices (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS conversation_participants (
+    conversation_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, conversation_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS conversation_permissions (
+    seq INTEGER PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    conversation_id TEXT NOT NULL,
+    conversation_key_id NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversation_permissions_key_id
+    ON conversation_permissions (conversation_key_id);
+CREATE INDEX IF NOT EXISTS conversation_permissions_owner_id_key_id
+    ON conversation_permissions (owner_id, conversation_key_id);
+CREATE INDEX IF NOT EXISTS conversation_permissions_conversation_id
+    ON conversation_permissions (conversation_id);
+
+CREATE TABLE IF NOT EXISTS message_logs (
+    conversation_id TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS blobs (
+    id TEXT PRIMARY KEY,
+    hash TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS blobs_hash ON blobs (hash);
+
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY,
+    time TEXT NOT NULL,
+    type TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    owner_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS changes_time ON changes (time);
+CREATE INDEX IF NOT EXISTS changes_conversation_id_seq ON changes (conversation_id, seq);
+"""
+
+class SqliteBackend:
+    """Implements the storage API on an SQLite database
+
+    Connections are pooled instead of opened per thread, as the threaded
+    REST server starts a new thread for every request.
+    """
+
+    def __init__(self, path):
+        # absolute, as connections may be opened after a chdir()
+        self.path = os.path.abspath(path)
+        self.idle_connections = []
+        self.local = threading.local()
+        # SQLite's busy handler polls with sleeps, writers of this process
+        # queue up here instead
+        self.write_lock = threading.Lock()
+        with self.connection() as connection:
+            # stored in the database file, needs a lock to change
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            self.add_changes_owner_column(connection)
+
+    @staticmethod
+    def add_changes_owner_column(connection):
+        """Upgrades change journals recorded without the owner of changes"""
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(changes)")]
+        if "owner_id" in columns:
+            return
+        connection.execute("ALTER TABLE changes ADD COLUMN owner_id INTEGER")
+        rows = connection.execute("SELECT seq, type, data FROM changes").fetchall()
+        owner_ids = [(storage.change_owner_id(change_type, json.loads(data)), seq)
+                     for seq, change_type, data in rows]
+        connection.executemany("UPDATE changes SET owner_id = ? WHERE seq = ?", owner_ids)
+
+    def connect(self):
+        connection = sqlite3.connect(
+            self.path, isolation_level=None, timeout=BUSY_TIMEOUT / 1000, check_same_thread=False)
+        connection.execute("PRAGMA synchronous={}".format("FULL" if storage.DURABLE_WRITES else "NORMAL"))
+        return connection
+
+    @contextlib.contextmanager
+    def connection(self):
+        """The connection of the thread's transaction or one from the pool"""
+        connection = getattr(self.local, "transaction", None)
+        if connection:
+            yield connection
+            return
+        try:
+            connection = self.idle_connections.pop()
+        except IndexError:
+            connection = self.connect()
+        try:
+            yield connection
+        finally:
+            self.idle_connections.append(connection)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Write transaction, taking the database's write lock right away"""
+        if getattr(self.local, "transaction", None):
+            # nested use joins the outer transaction
+            yield self.local.transaction
+            return
+        with self.write_lock, self.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            self.local.transaction = connection
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+            finally:
+                self.local.transaction = None
+
+    def query(self, sql, *params):
+        with self.connection() as connection:
+            return connection.execute(sql, params).fetchall()
+
+    def query_data(self, sql, *params):
+        """Entities decoded from the data column of all rows"""
+        return [json.loads(row[0]) for row in self.query(sql, *params)]
+
+    def query_one(self, sql, *params):
+        rows = self.query_data(sql, *params)
+        return rows[0] if rows else None
+
+    @staticmethod
+    def dumps(obj, kind):
+        data = json.dumps(obj)
+        metrics.STORAGE_BYTES_WRITTEN.inc(len(data), (kind,))
+        return data
+
+    # Messages
+
+    def ensure_message_log(self, conversation_id):
+        if not self.query("SELECT 1 FROM message_logs WHERE conversation_id = ?", conversation_id):
+            raise FileNotFoundError("No messages for conversation {}".format(conversation_id))
+
+    def create_messages_file(self, conversation_id):
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO message_logs VALUES (?)", (conversation_id,))
+            connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+
+    def update_messages_index(self, conversation_id):
+        self.ensure_message_log(conversation_id)
+        return self.query("SELECT COUNT(*) FROM messages WHERE conversation_id = ?", conversation_id)[0][0]
+
+    def get_messages_page(self, conversation_id, before_id, limit):
+        self.ensure_message_log(conversation_id)
+        if before_id is None:
+            messages = self.query_data(
+                "SELECT data FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                conversation_id, limit)
+        else:
+            messages = self.query_data(
+                "SELECT data FROM messages WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                conversation_id, before_id, limit)
+        messages.reverse()
+        # IDs are contiguous from 1
+        return messages, bool(messages) and messages[0]["id"] > 1
+
+    def get_latest_message(self, conversation_id):
+        self.ensure_message_log(conversation_id)
+        return self.query_one(
+            "SELECT data FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT 1",
+            conversation_id)
+
+    def get_all_messages(self, conversation_id):
+        self.ensure_message_log(conversation_id)
+        return self.query_data(
+            "SELECT data FROM messages WHERE conversation_id = ? ORDER BY id", conversation_id)
+
+    def append_messages(self, new_messages, conversation_id):
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO message_logs VALUES (?)", (conversation_id,))
+            row = connection.execute(
+                "SELECT MAX(id) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()
+            previous_message_id = row[0] or 0
+            results = []
+            rows = []
+            for new_message in new_messages:
+                context = new_message.get("context") or {}
+                if previous_message_id != context.get("previousMessageId"):
+                    results.append(storage.WrongPreviousMessageIdInContext())
+                    continue
+
+                new_id = previous_message_id + 1
+                storage.assign_id_and_time_to_server_message(new_message, new_id)
+                previous_message_id = new_id
+                rows.append((conversation_id, new_id, self.dumps(new_message, "messages")))
+                results.append(new_message)
+
+            connection.executemany("INSERT INTO messages VALUES (?, ?, ?)", rows)
+            self.record_changes(connection, [
+                ("message.added", conversation_id, {"id": message_id})
+                for _, message_id, _ in rows
+            ])
+            return results
+
+    # Change journal, see storage.py. Message changes reference rows of the
+    # messages table.
+
+    def record_changes(self, connection, changes):
+        now = storage.rfc3339_now()
+        connection.executemany(
+            "INSERT INTO changes (time, type, conversation_id, data, owner_id) VALUES (?, ?, ?, ?, ?)",
+            [(now, change_type, conversation_id, self.dumps(data, "changes"),
+              storage.change_owner_id(change_type, data))
+             for change_type, conversation_id, data in changes])
+
+    def get_latest_changes_cursor(self):
+        return self.query("SELECT COALESCE(MAX(seq), 0) FROM changes")[0][0]
+
+    def get_changes_cursor_at(self, rfc3339_time):
+        return self.query("SELECT COALESCE(MAX(seq), 0) FROM changes WHERE time <= ?", rfc3339_time)[0][0]
+
+    def get_changes(self, user_id, cursor, limit):
+        conversation_ids = sorted(self.get_user_conversation_ids(user_id))
+        # changes committed after this are left for the next call
+        latest_cursor = self.get_latest_changes_cursor()
+        rows = self.query(
+            "SELECT seq, time, type, conversation_id, data FROM changes "
+            "WHERE seq > ? AND seq <= ? AND conversation_id IN ({}) "
+            "AND (owner_id IS NULL OR owner_id = ?) ORDER BY seq LIMIT ?".format(
+                ",".join("?" * len(conversation_ids))),
+            cursor, latest_cursor, *conversation_ids, user_id, limit)
+        changes = [
+            {
+                "seq": seq,
+                "time": change_time,
+                "type": change_type,
+                "conversationId": conversation_id,
+                "data": json.loads(data),
+            }
+            for seq, change_time, change_type, conversation_id, data in rows
+        ]
+        if len(changes) == limit:
+            return self.resolve_message_changes(changes), changes[-1]["seq"], True
+        # nothing else visible up to the latest change
+        return self.resolve_message_changes(changes), max(cursor, latest_cursor), False
+
+    def resolve_message_changes(self, changes):
+        """See storage.resolve_message_changes, reads the messages with one
+        query per conversation"""
+        messages = {}
+        for conversation_id, ids in storage.referenced_message_ids(changes).items():
+            rows = self.query(
+                "SELECT id, data FROM messages WHERE conversation_id = ? AND id BETWEEN ? AND ?",
+                conversation_id, min(ids), max(ids))
+            for message_id, data in rows:
+                messages[(conversation_id, message_id)] = json.loads(data)
+        return storage.replace_message_references(changes, messages)
+
+    # Conversations and permissions
+
+    def get_all_conversation_permissions(self):
+        return self.query_data("SELECT data FROM conversation_permissions ORDER BY seq")
+
+    def get_conversation_permission(self, owner_id, conversation_key_id):
+        return self.query_one(
+            "SELECT data FROM conversation_permissions WHERE owner_id = ? AND conversation_key_id = ? "
+            "ORDER BY seq DESC LIMIT 1", owner_id, conversation_key_id)
+
+    def get_conversation_permissions(self, owner_id, conversation_key_ids):
+        conversation_key_ids = list(conversation_key_ids)
+        rows = self.query(
+            "SELECT conversation_key_id, data FROM conversation_permissions "
+            "WHERE owner_id = ? AND conversation_key_id IN ({}) ORDER BY seq".format(
+                ",".join("?" * len(conversation_key_ids))),
+            owner_id, *conversation_key_ids)
+        # later permissions replace earlier ones for the same key ID
+        return {conversation_key_id: json.loads(data) for conversation_key_id, data in rows}
+
+    def get_conversation_id_by_key_id(self, conversation_key_id):
+        rows = self.query(
+            "SELECT conversation_id FROM conversation_permissions WHERE conversation_key_id = ? "
+            "ORDER BY seq DESC LIMIT 1", conversation_key_id)
+        if not rows:
+            raise KeyError(conversation_key_id)
+        return rows[0][0]
+
+    def get_conversation_member_ids(self, conversation_id):
+        member_ids = {
+            row[0]
+            for row in self.query(
+                "SELECT owner_id FROM conversation_permissions WHERE conversation_id = ?", conversation_id)
+        }
+        conversation = self.get_conversation(conversation_id)
+        if conversation:
+            member_ids.update(conversation["participantIds"])
+        return member_ids
+
+    def get_user_conversation_ids(self, user_id):
+        return {
+            row[0]
+            for row in self.query(
+                "SELECT conversation_id FROM conversation_permissions WHERE owner_id = ? "
+                "UNION SELECT conversation_id FROM conversation_participants WHERE user_id = ?",
+                user_id, user_id)
+        }
+
+    def get_user_conversation_permissions(self, user_id, conversation_ids):
+        conversation_ids = list(conversation_ids)
+        return self.query_data(
+            "SELECT data FROM conversation_permissions WHERE owner_id = ? AND conversation_id IN ({}) "
+            "ORDER BY seq".format(",".join("?" * len(conversation_ids))),
+            user_id, *conversation_ids)
+
+    def get_user_conversations_page(self, user_id, after_id, limit):
+        conversations = self.query_data(
+            "SELECT data FROM conversations WHERE id IN ("
+            "SELECT conversation_id FROM conversation_permissions WHERE owner_id = ? "
+            "UNION SELECT conversation_id FROM conversation_participants WHERE user_id = ?"
+            ") AND id > ? ORDER BY id LIMIT ?",
+            user_id, user_id, after_id if after_id is not None else "", limit + 1)
+        return conversations[:limit], len(conversations) > limit
+
+    def get_all_conversations(self):
+        return self.query_data("SELECT data FROM conversations ORDER BY rowid")
+
+    def get_conversation(self, conversation_id):
+        return self.query_one("SELECT data FROM conversations WHERE id = ?", conversation_id)
+
+    def update_conversation(self, conversation):
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE conversations SET data = ? WHERE id = ?",
+                (self.dumps(conversation, "document"), conversation["id"]))
+            if not cursor.rowcount:
+                raise Exception("Conversation to update not found.")
+            self.insert_participants(connection, conversation)
+            self.record_changes(connection, [("conversation.updated", conversation["id"], conversation)])
+
+    def update_conversation_participants(self, conversation_id, action, user_id):
+        with self.transaction():
+            conversation = self.get_conversation(conversation_id)
+            if action == "join":
+                conversation["participantIds"].append(user_id)
+            elif action == "leave":
+                conversation["participantIds"].remove(user_id)
+            self.update_conversation(conversation)
+            return conversation
+
+    @staticmethod
+    def insert_participants(connection, conversation):
+        connection.execute("DELETE FROM conversation_participants WHERE conversation_id = ?", (conversation["id"],))
+        connection.executemany(
+            "INSERT OR IGNORE INTO conversation_participants VALUES (?, ?)",
+            [(conversation["id"], user_id) for user_id in conversation["participantIds"]])
+
+    def insert_conversation(self, connection, conversation):
+        connection.execute(
+            "INSERT OR REPLACE INTO conversations VALUES (?, ?)",
+            (conversation["id"], self.dumps(conversation, "document")))
+        self.insert_participants(connection, conversation)
+
+    def insert_conversation_permission(self, connection, permission):
+        connection.execute(
+            "INSERT INTO conversation_permissions (owner_id, conversation_id, conversation_key_id, data) "
+            "VALUES (?, ?, ?, ?)",
+            (permission["ownerId"], permission["conversationId"], permission["conversationKeyId"],
+             self.dumps(permission, "document")))
+
+    def append_conversation(self, conversation):
+        with self.transaction() as connection:
+            self.insert_conversation(connection, conversation)
+            self.record_changes(connection, [("conversation.added", conversation["id"], conversation)])
+
+    def append_conversation_permission(self, permission):
+        with self.transaction() as connection:
+            self.insert_conversation_permission(connection, permission)
+            self.record_changes(
+                connection, [("conversation_permission.added", permission["conversationId"], permission)])
+
+    # Devices
+
+    def get_all_devices(self):
+        return {device["id"]: device for device in self.query_data("SELECT data FROM devices ORDER BY rowid")}
+
+    def get_device(self, device_id):
+        device = self.query_one("SELECT data FROM devices WHERE id = ?", device_id)
+        if device is None:
+            raise KeyError(device_id)
+        return device
+
+    def get_devices(self, device_ids):
+        device_ids = list(device_ids)
+        rows = self.query(
+            "SELECT id, data FROM devices WHERE id IN ({})".format(",".join("?" * len(device_ids))), *device_ids)
+        return {device_id: json.loads(data) for device_id, data in rows}
+
+    def append_device(self, device):
+        new_device = copy.deepcopy(device)
+        new_device["state"] = "active"
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO devices VALUES (?, ?)",
+                (new_device["id"], self.dumps(new_device, "document")))
+        return new_device
+
+    # Blobs
+
+    def get_blob(self, blob_id):
+        rows = self.query("SELECT hash, size FROM blobs WHERE id = ?", blob_id)
+        return {"hash": rows[0][0], "size": rows[0][1]} if rows else None
+
+    def get_blob_reference_counts(self):
+        return dict(self.query("SELECT hash, COUNT(*) FROM blobs WHERE hash IS NOT NULL GROUP BY hash"))
+
+    def reserve_blob_ids(self, blob_ids):
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO blobs VALUES (?, NULL, NULL)", [(blob_id,) for blob_id in blob_ids])
+
+    def set_blob_content(self, blob_id, content_hash, size):
+        with self.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)", (blob_id, content_hash, size))
+
+    # Users
+
+    def get_all_users(self):
+        return self.query_data("SELECT data FROM users ORDER BY id")
+
+    def get_users_page(self, after_id, limit):
+        users = self.query_data(
+            "SELECT data FROM users WHERE id > ? ORDER BY id LIMIT ?",
+            after_id if after_id is not None else 0, limit + 1)
+        return users[:limit], len(users) > limit
+
+    def get_user(self, user_id):
+        return self.query_one("SELECT data FROM users WHERE id = ?", user_id)
+
+    def get_users(self, user_ids):
+        user_ids = list(user_ids)
+        rows = self.query(
+            "SELECT id, data FROM users WHERE id IN ({})".format(",".join("?" * len(user_ids))), *user_ids)
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def find_user(self, email):
+        return self.query_one("SELECT data FROM users WHERE email = ?", email)
+
+    def find_user_by_login_key(self, login_key):
+        return self.query_one(
+            "SELECT data FROM users WHERE login_key = ? ORDER BY id DESC LIMIT 1", login_key)
+
+    def append_user(self, user):
+        new_user = copy.deepcopy(user)
+        if not "picture" in new_user:
+            new_user["picture"] = None
+        with self.transaction() as connection:
+            if connection.execute("SELECT 1 FROM users WHERE email = ?", (new_user["email"],)).fetchone():
+                raise storage.UserAlreadyExists()
+            max_id = connection.execute("SELECT MAX(id) FROM users").fetchone()[0] or 0
+            new_user["id"] = max_id + 1
+            connection.execute(
+                "INSERT INTO users VALUES (?, ?, ?, ?)",
+                (new_user["id"], new_user["email"], new_user.get("loginKey"),
+                 self.dumps(new_user, "document")))
+        return new_user
+
+def migrate(backend):
+    """Imports all entities from the JSON files in storage.DATABASE_DIR"""
+    with backend.transaction() as connection:
+        for user in storage.get_all_users():
+            connection.execute(
+                "INSERT INTO users VALUES (?, ?, ?, ?)",
+                (user["id"], user["email"], user.get("loginKey"), json.dumps(user)))
+        for device in storage.get_all_devices().values():
+            connection.execute(
+                "INSERT INTO devices VALUES (?, ?)", (device["id"], json.dumps(device)))
+        for conversation in storage.get_all_conversations():
+            backend.insert_conversation(connection, conversation)
+        for permission in storage.get_all_conversation_permissions():
+            backend.insert_conversation_permission(connection, permission)
+        for blob_id, blob in storage.load_blobs()[0].items():
+            backend.set_blob_content(blob_id, blob["hash"], blob["size"])
+
+        conversation_ids = set()
+        for pattern in [storage.DATABASE_FILE_MESSAGES, storage.DATABASE_FILE_MESSAGES_LEGACY]:
+            prefix, suffix = pattern.split("{}")
+            for path in glob.glob(pattern.format("*")):
+                conversation_ids.add(path[len(prefix):-len(suffix)])
+        message_count = 0
+        for conversation_id in sorted(conversation_ids):
+            messages = storage.get_all_messages(conversation_id)
+            connection.execute("INSERT INTO message_logs VALUES (?)", (conversation_id,))
+            connection.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?)",
+                [(conversation_id, message["id"], json.dumps(message)) for message in messages])
+            message_count += len(messages)
+
+        if os.path.exists(storage.DATABASE_FILE_CHANGES):
+            with open(storage.DATABASE_FILE_CHANGES, "r") as f:
+                changes = [json.loads(line) for line in f if line.endswith("\n")]
+            connection.executemany(
+                "INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)",
+                [(c["seq"], c["time"], c["type"], c["conversationId"], json.dumps(c["data"]),
+                  storage.change_owner_id(c["type"], c["data"])) for c in changes])
+    return len(conversation_ids), message_count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="import the JSON files of {}".format(storage.DATABASE_DIR))
+    migrate_parser.add_argument("--sqlite-file", default=storage.SQLITE_FILE,
+                                help="database file to create")
+    migrate_parser.add_argument("--force", action="store_true",
+                                help="replace an existing database file")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        if os.path.exists(args.sqlite_file):
+            if not args.force:
+                print("{} exists, use --force to replace it".format(args.sqlite_file))
+                return 1
+            for suffix in ["", "-wal", "-shm"]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(args.sqlite_file + suffix)
+        conversation_count, message_count = migrate(SqliteBackend(args.sqlite_file))
+        print("Imported {} messages of {} conversations into {}".format(
+            message_count, conversation_count, args.sqlite_file))
+        return 0
+
+    parser.print_help()
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
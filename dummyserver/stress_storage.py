@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#pylint:disable=missing-docstring,invalid-name
+"""Stress test for concurrent message appends
+
+Runs many writer processes with several threads each against a single
+conversation in a temporary database directory. Every writer retries until
+its messages are accepted. Afterwards the message IDs must be contiguous and
+the offset index must match the log.
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import storage
+
+CONVERSATION_ID = "c0ffee"
+
+def write_messages(count, writer_name):
+    for number in range(count):
+        while True:
+            latest = storage.get_latest_message(CONVERSATION_ID)
+            message = {
+                "context": {
+                    "previousMessageId": latest["id"] if latest else 0,
+                },
+                "writer": writer_name,
+                "number": number,
+            }
+            try:
+                storage.append_message(message, CONVERSATION_ID)
+                break
+            except storage.WrongPreviousMessageIdInContext:
+                pass
+
+def run_process(process_number, threads, messages):
+    workers = [
+        threading.Thread(target=write_messages, args=(messages, "{}.{}".format(process_number, t)))
+        for t in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def check(expected_count):
+    messages = storage.get_all_messages(CONVERSATION_ID)
+    ids = [m["id"] for m in messages]
+    if ids != list(range(1, expected_count + 1)):
+        return "message IDs are not contiguous or messages are missing ({} of {})".format(
+            len(ids), expected_count)
+
+    per_writer = {}
+    for m in messages:
+        per_writer.setdefault(m["writer"], []).append(m["number"])
+    for writer, numbers in per_writer.items():
+        if numbers != sorted(set(numbers)):
+            return "messages of writer {} are duplicated or out of order".format(writer)
+
+    page, _ = storage.get_messages_page(CONVERSATION_ID, None, expected_count)
+    if page != messages:
+        return "index does not match the log"
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=50, help="messages per thread")
+    storage.add_arguments(parser)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="kullo-stress-")
+    try:
+        os.chdir(workdir)
+        os.mkdir(storage.DATABASE_DIR)
+        storage.configure(args)
+        storage.create_messages_file(CONVERSATION_ID)
+
+        processes = [
+            multiprocessing.Process(target=run_process, args=(p, args.threads, args.messages))
+            for p in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        expected_count = args.processes * args.threads * args.messages
+        error = check(expected_count)
+        if error:
+            print("FAILED: {}".format(error))
+            return 1
+        print("OK: {} messages appended by {} writers".format(
+            expected_count, args.processes * args.threads))
+        return 0
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    sys.exit(main())
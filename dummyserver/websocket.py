@@ -1,35 +1,213 @@
 #!/usr/bin/env python3
-#pylint:disable=missing-docstring,invalid-name
+#pylint:disable=missing-docstring,invalid-name,wrong-import-position
 
+import argparse
 import asyncio
+import http
 import json
-import websockets
+import multiprocessing
+import os
 import secrets
+import signal
 import string
 import sys
+import time
 import urllib
 
+import websockets
+import websockets.version
+
+# websockets.frames and the compression options of serve() need version 10,
+# checked before the import fails with a less helpful error
+if int(websockets.version.version.split(".")[0]) < 10:
+    print("Python package websockets version >= 10 required.")
+    sys.exit(1)
+
+import websockets.extensions.permessage_deflate
+import websockets.frames
+
+import async_http
+import async_storage
+import eventbus
+import metrics
+import protocol
+import serialization
 import storage
 
 HOST = "localhost"
 PORT = 8765
+OUTBOX_SIZE = 256 # frames queued for a connection before it is dropped
+MAX_BATCH_SIZE = 100 # IDs of a *.get_many request or requests of a batch
+STATS_INTERVAL = 0 # seconds between send statistics reports, 0 disables them
+WORKERS = 1 # server processes sharing the port, connected by the event bus
+
+# permessage-deflate, used when the client offers it. Each compressing
+# connection holds about 2^(window bits + 2) + 2^(memory level + 9) bytes of
+# zlib state, unless context takeover is off.
+COMPRESSION = True
+DEFLATE_WINDOW_BITS = 12 # 9-15
+DEFLATE_MEM_LEVEL = 5 # 1-9
+DEFLATE_NO_CONTEXT_TAKEOVER = False # compress each message on its own
+MAX_MESSAGE_SIZE = 1024 * 1024 # bytes of an incoming message
+MAX_QUEUE = 32 # incoming messages buffered per connection
+WRITE_LIMIT = 64 * 1024 # bytes buffered for writing before a send waits
+
+# Connections negotiating this subprotocol receive message.added events as
+# binary MessagePack frames, everything else stays JSON
+MSGPACK_SUBPROTOCOL = "kullo.msgpack"
+MSGPACK = False
 
 EVENT_LOOP = asyncio.get_event_loop()
-ALL_CONNECTIONS = []
+ALL_CONNECTIONS = set()
+CONNECTIONS_BY_USER = {} # user ID -> set of connections
+SUBSCRIPTIONS = {} # conversation ID -> set of user IDs
+OUTBOXES = {} # connection -> Outbox
+SEND_LATENCY_MAX = 0.0 # since the last statistics report
+EVENT_BUS = None # eventbus.BusClient of a worker process
+metrics.WEBSOCKET_CONNECTIONS.function = lambda: len(ALL_CONNECTIONS)
 
 class RequestError(Exception):
     pass
 
-async def broadcast(event, sender):
-    receivers = [c for c in ALL_CONNECTIONS if c != sender]
-    event_as_string = json.dumps(event)
+class MeasuredPerMessageDeflateFactory(websockets.extensions.permessage_deflate.ServerPerMessageDeflateFactory):
+    """permessage-deflate that counts the compressed size of sent data frames"""
 
-    print("Broadcasting {} to {}".format("event", receivers))
-    for connection in receivers:
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        encode = extension.encode
+
+        def measured_encode(frame):
+            frame = encode(frame)
+            if frame.opcode not in websockets.frames.CTRL_OPCODES:
+                metrics.WEBSOCKET_COMPRESSED_BYTES.inc(len(frame.data))
+            return frame
+
+        extension.encode = measured_encode
+        return response_params, extension
+
+class Outbox:
+    """Bounded queue of outgoing frames, sent by one task per connection
+
+    A slow receiver only fills its own queue instead of delaying everybody
+    else. When the queue is full, the receiver is disconnected.
+    """
+
+    def __init__(self, connection, user_id):
+        self.connection = connection
+        self.user_id = user_id
+        self.compact = connection.subprotocol == MSGPACK_SUBPROTOCOL
+        self.queue = asyncio.Queue(OUTBOX_SIZE)
+        self.task = asyncio.ensure_future(self.run())
+
+    def put(self, frame, size):
         try:
-            await connection.send(event_as_string)
-        except websockets.exceptions.ConnectionClosed:
-            pass
+            self.queue.put_nowait((frame, size, time.monotonic()))
+        except asyncio.QueueFull:
+            print("Dropping connection {} lagging behind by {} frames".format(
+                hex(id(self.connection)), self.queue.qsize()))
+            metrics.WEBSOCKET_DROPPED_CONNECTIONS.inc()
+            remove_connection(self.connection, self.user_id)
+            asyncio.ensure_future(self.connection.close(1013, "Too slow"))
+
+    def close(self):
+        self.task.cancel()
+
+    async def run(self):
+        global SEND_LATENCY_MAX
+        while True:
+            frame, size, enqueued = await self.queue.get()
+            try:
+                await self.connection.send(frame)
+            except websockets.exceptions.ConnectionClosed:
+                return
+            latency = time.monotonic() - enqueued
+            metrics.WEBSOCKET_SENT_FRAMES.inc()
+            metrics.WEBSOCKET_SENT_BYTES.inc(size, ("msgpack" if isinstance(frame, bytes) else "json",))
+            metrics.WEBSOCKET_SEND_SECONDS.observe(latency)
+            SEND_LATENCY_MAX = max(SEND_LATENCY_MAX, latency)
+
+async def report_send_stats():
+    global SEND_LATENCY_MAX
+    last_count, last_sum = 0, 0.0
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        depths = [outbox.queue.qsize() for outbox in OUTBOXES.values()]
+        count, latency_sum = metrics.WEBSOCKET_SEND_SECONDS.totals()
+        sent = count - last_count
+        print("Sent {} frames, latency avg {:.1f} ms max {:.1f} ms; queue depth max {} total {}; {} connections, {} dropped".format(
+            sent,
+            1000 * (latency_sum - last_sum) / sent if sent else 0,
+            1000 * SEND_LATENCY_MAX,
+            max(depths, default=0),
+            sum(depths),
+            len(ALL_CONNECTIONS),
+            metrics.WEBSOCKET_DROPPED_CONNECTIONS.totals(),
+        ))
+        last_count, last_sum = count, latency_sum
+        SEND_LATENCY_MAX = 0.0
+
+async def subscribed_user_ids(conversation_id):
+    if conversation_id not in SUBSCRIPTIONS:
+        SUBSCRIPTIONS[conversation_id] = await async_storage.get_conversation_member_ids(conversation_id)
+    return SUBSCRIPTIONS[conversation_id]
+
+async def update_subscriptions(conversation_id):
+    SUBSCRIPTIONS[conversation_id] = await async_storage.get_conversation_member_ids(conversation_id)
+
+def add_connection(connection, user_id):
+    ALL_CONNECTIONS.add(connection)
+    CONNECTIONS_BY_USER.setdefault(user_id, set()).add(connection)
+    OUTBOXES[connection] = Outbox(connection, user_id)
+
+def remove_connection(connection, user_id):
+    ALL_CONNECTIONS.discard(connection)
+    outbox = OUTBOXES.pop(connection, None)
+    if outbox:
+        outbox.close()
+    user_connections = CONNECTIONS_BY_USER.get(user_id, set())
+    user_connections.discard(connection)
+    if not user_connections:
+        CONNECTIONS_BY_USER.pop(user_id, None)
+
+async def broadcast(event, sender, conversation_id):
+    # serialized once for all receivers
+    event_as_bytes = serialization.dumps_bytes(event)
+    if EVENT_BUS:
+        EVENT_BUS.publish(conversation_id, event["type"], event_as_bytes)
+    await deliver(event_as_bytes, event["type"], sender, conversation_id, event)
+
+async def deliver_published(conversation_id, event_type, event_as_bytes):
+    """Delivers an event broadcast by another worker process"""
+    if event_type == "conversation.updated":
+        # the members changed
+        await update_subscriptions(conversation_id)
+    await deliver(event_as_bytes, event_type, None, conversation_id)
+
+async def deliver(event_as_bytes, event_type, sender, conversation_id, event=None):
+    """Queues a serialized event for this process' connections of the
+    conversation's members except `sender`"""
+    receivers = [
+        c
+        for user_id in await subscribed_user_ids(conversation_id)
+        for c in CONNECTIONS_BY_USER.get(user_id, ())
+        if c != sender
+    ]
+    event_as_string = event_as_bytes.decode()
+    metrics.BROADCAST_FAN_OUT.observe(len(receivers))
+
+    serialization.log_frame("Broadcasting to {}:".format(len(receivers)), event_as_string)
+    compact_frame = None
+    for connection in receivers:
+        outbox = OUTBOXES.get(connection)
+        if not outbox:
+            continue
+        if outbox.compact and event_type == "message.added":
+            if compact_frame is None:
+                # encoded once, for the first receiver asking for it
+                compact_frame = serialization.dumps_msgpack(event if event is not None else json.loads(event_as_bytes))
+            outbox.put(compact_frame, len(compact_frame))
+        else:
+            outbox.put(event_as_string, len(event_as_bytes))
 
 def generate_id(length=20):
     alphabet = string.ascii_uppercase + string.ascii_lowercase + string.digits
@@ -47,25 +225,28 @@ def make_response(request):
     }
 
 
-def key_id_to_conv_id(keyId):
-    table = {}
-    for permission in storage.get_all_conversation_permissions():
-        table[permission["conversationKeyId"]] = permission["conversationId"]
-    return table[keyId]
+def make_error_response(request, error_message):
+    return {
+        "type": "response",
+        "meta": {
+            "requestId": request["id"],
+            "error": error_message
+        }
+    }
 
 
 async def handle_request_message_new(request, sender_connection):
     message = request["data"]
-    conversation_id = key_id_to_conv_id(message["context"]["conversationKeyId"])
+    conversation_id = await async_storage.get_conversation_id_by_key_id(message["context"]["conversationKeyId"])
 
     try:
-        stored_message = storage.append_message(message, conversation_id)
+        stored_message = await async_storage.append_message(message, conversation_id)
 
         event = {
             "type": "message.added",
             "data": stored_message
         }
-        await broadcast(event, sender_connection)
+        await broadcast(event, sender_connection, conversation_id)
 
         response = make_response(request)
         response["data"] = stored_message
@@ -77,18 +258,14 @@ async def handle_request_message_new(request, sender_connection):
 async def handle_request_conversation_joinleave(action, user_id, request, sender_connection):
     conversation_id = request["data"]["id"]
 
-    conversation = storage.get_conversation(conversation_id)
-    if action == "join":
-        conversation["participantIds"].append(user_id)
-    elif action == "leave":
-        conversation["participantIds"].remove(user_id)
-    storage.update_conversation(conversation)
+    conversation = await async_storage.update_conversation_participants(conversation_id, action, user_id)
+    await update_subscriptions(conversation_id)
 
     event = {
         "type": "conversation.updated",
         "data": conversation
     }
-    await broadcast(event, sender_connection)
+    await broadcast(event, sender_connection, conversation_id)
 
     response = make_response(request)
     response["data"] = conversation
@@ -96,7 +273,7 @@ async def handle_request_conversation_joinleave(action, user_id, request, sender
 
 async def handle_request_device_get(request, sender_connection):
     device_id = request["data"]["id"]
-    stored_device = storage.get_device(device_id)
+    stored_device = await async_storage.get_device(device_id)
 
     response = make_response(request)
     response["data"] = stored_device
@@ -106,12 +283,7 @@ async def handle_request_device_get(request, sender_connection):
 async def handle_request_conversation_permission_get(owner_id, request, sender_connection):
     conversation_key_id = request["data"]["conversationKeyId"]
 
-    out_permission = None
-    for permission in storage.get_all_conversation_permissions():
-        if permission["ownerId"] == owner_id and permission["conversationKeyId"] == conversation_key_id:
-            out_permission = permission
-            break
-
+    out_permission = await async_storage.get_conversation_permission(owner_id, conversation_key_id)
     if not out_permission:
         raise RequestError("Permission with key ID {} and owner {} not found".format(conversation_key_id, owner_id))
 
@@ -123,12 +295,90 @@ async def handle_request_conversation_permission_get(owner_id, request, sender_c
 async def handle_request_user_get(request, sender_connection):
     user_id = request["data"]["id"]
 
-    stored_user = storage.get_user(user_id)
+    stored_user = await async_storage.get_user(user_id)
     if not stored_user:
         raise RequestError("User with ID {} not found".format(user_id))
 
     response = make_response(request)
-    response["data"] = stored_user
+    response["data"] = protocol.project([stored_user], protocol.PUBLIC_USER_FIELDS)[0]
+    return response
+
+
+def batch_ids(request, key):
+    """The distinct IDs of a *.get_many request in request order"""
+    ids = (request.get("data") or {}).get(key)
+    if not isinstance(ids, list):
+        raise RequestError("List '{}' required".format(key))
+    if len(ids) > MAX_BATCH_SIZE:
+        raise RequestError("Too many IDs: {} > {}".format(len(ids), MAX_BATCH_SIZE))
+    return list(dict.fromkeys(ids))
+
+
+def make_batch_response(request, ids, objects_by_id):
+    """Found objects in request order and the IDs that were not found"""
+    response = make_response(request)
+    response["data"] = {
+        "objects": [objects_by_id[i] for i in ids if i in objects_by_id],
+        "missingIds": [i for i in ids if i not in objects_by_id],
+    }
+    return response
+
+
+async def handle_request_user_get_many(request, sender_connection):
+    user_ids = batch_ids(request, "ids")
+    users = await async_storage.get_users(user_ids)
+    public_users = {
+        user_id: user
+        for user_id, user in zip(users, protocol.project(users.values(), protocol.PUBLIC_USER_FIELDS))
+    }
+    return make_batch_response(request, user_ids, public_users)
+
+
+async def handle_request_device_get_many(request, sender_connection):
+    device_ids = batch_ids(request, "ids")
+    return make_batch_response(request, device_ids, await async_storage.get_devices(device_ids))
+
+
+async def handle_request_conversation_permission_get_many(owner_id, request, sender_connection):
+    conversation_key_ids = batch_ids(request, "conversationKeyIds")
+    permissions = await async_storage.get_conversation_permissions(owner_id, conversation_key_ids)
+    return make_batch_response(request, conversation_key_ids, permissions)
+
+
+async def handle_request_batch(user_id, request, sender_connection):
+    """Handles the requests in data.requests one after another and returns
+    all their responses in one frame"""
+    requests = (request.get("data") or {}).get("requests")
+    if not isinstance(requests, list):
+        raise RequestError("List 'requests' required")
+    if len(requests) > MAX_BATCH_SIZE:
+        raise RequestError("Too many requests: {} > {}".format(len(requests), MAX_BATCH_SIZE))
+
+    responses = []
+    for sub_request in requests:
+        if sub_request.get("type") == "batch":
+            responses.append(make_error_response(sub_request, "Nested batch requests are not supported"))
+            continue
+        try:
+            responses.append(await handle_request(user_id, sub_request, sender_connection))
+        except RequestError as e:
+            responses.append(make_error_response(sub_request, str(e)))
+
+    response = make_response(request)
+    response["data"] = {"responses": responses}
+    return response
+
+
+async def handle_request_sync_get(user_id, request, sender_connection):
+    data = request.get("data") or {}
+    try:
+        cursor, since, limit = protocol.parse_sync_params(data.get("cursor"), data.get("since"), data.get("limit"))
+        changes, next_cursor, more_available = await async_storage.sync_changes(user_id, cursor, since, limit)
+    except ValueError as e:
+        raise RequestError("Invalid sync parameters: {}".format(e))
+
+    response = make_response(request)
+    response["data"] = protocol.sync_response_body(changes, next_cursor, more_available)
     return response
 
 
@@ -143,11 +393,64 @@ async def handle_request_attachments_new(request, sender_connection):
             "id": attachment_id,
             "uploadUrl": "http://localhost:8000/blob/{}".format(attachment_id),
         })
+    await async_storage.reserve_blob_ids([a["id"] for a in attachments])
     response["data"] = attachments
 
     return response
 
 
+REQUEST_TYPES = {
+    "message.new",
+    "device.get",
+    "conversation.join",
+    "conversation.leave",
+    "conversation_permission.get",
+    "user.get",
+    "attachments.new",
+    "sync.get",
+    "user.get_many",
+    "device.get_many",
+    "conversation_permission.get_many",
+    "batch",
+}
+
+async def handle_request(user_id, request, connection):
+    """Returns the response to a request, raises RequestError"""
+    if request["type"] == "message.new":
+        return await handle_request_message_new(request, connection)
+    elif request["type"] == "device.get":
+        return await handle_request_device_get(request, connection)
+    elif request["type"] == "conversation.join":
+        return await handle_request_conversation_joinleave("join", user_id, request, connection)
+    elif request["type"] == "conversation.leave":
+        return await handle_request_conversation_joinleave("leave", user_id, request, connection)
+    elif request["type"] == "conversation_permission.get":
+        return await handle_request_conversation_permission_get(user_id, request, connection)
+    elif request["type"] == "user.get":
+        return await handle_request_user_get(request, connection)
+    elif request["type"] == "attachments.new":
+        return await handle_request_attachments_new(request, connection)
+    elif request["type"] == "sync.get":
+        return await handle_request_sync_get(user_id, request, connection)
+    elif request["type"] == "user.get_many":
+        return await handle_request_user_get_many(request, connection)
+    elif request["type"] == "device.get_many":
+        return await handle_request_device_get_many(request, connection)
+    elif request["type"] == "conversation_permission.get_many":
+        return await handle_request_conversation_permission_get_many(user_id, request, connection)
+    elif request["type"] == "batch":
+        return await handle_request_batch(user_id, request, connection)
+    else:
+        error_message = "Unknown request type: '{}'".format(request["type"])
+        # print(error_message)
+        raise RequestError(error_message)
+
+def process_http_request(path, request_headers):
+    # plain HTTP requests for the metrics, everything else is a websocket
+    if path == "/metrics":
+        return (http.HTTPStatus.OK, [("Content-Type", metrics.CONTENT_TYPE)], metrics.render().encode())
+    return None
+
 async def single_connection_handler(connection, path):
     identifier = hex(id(connection))
     print("+1 {} opened connection via {}".format(identifier, path))
@@ -156,56 +459,175 @@ async def single_connection_handler(connection, path):
     #print(query)
     authenticated_user_id = int(query["authenticated_user_id"][0])
 
-    ALL_CONNECTIONS.append(connection)
+    add_connection(connection, authenticated_user_id)
     try:
         async for request_as_string in connection:
-            #print("< {}".format(request_as_string))
+            serialization.log_frame("<", request_as_string)
             request = json.loads(request_as_string)
+            start = time.perf_counter()
+            error = False
 
             try:
-                if request["type"] == "message.new":
-                    response = await handle_request_message_new(request, connection)
-                elif request["type"] == "device.get":
-                    response = await handle_request_device_get(request, connection)
-                elif request["type"] == "conversation.join":
-                    response = await handle_request_conversation_joinleave("join", authenticated_user_id, request, connection)
-                elif request["type"] == "conversation.leave":
-                    response = await handle_request_conversation_joinleave("leave", authenticated_user_id, request, connection)
-                elif request["type"] == "conversation_permission.get":
-                    response = await handle_request_conversation_permission_get(authenticated_user_id, request, connection)
-                elif request["type"] == "user.get":
-                    response = await handle_request_user_get(request, connection)
-                elif request["type"] == "attachments.new":
-                    response = await handle_request_attachments_new(request, connection)
-                else:
-                    error_message = "Unknown request type: '{}'".format(request["type"])
-                    # print(error_message)
-                    raise RequestError(error_message)
+                response = await handle_request(authenticated_user_id, request, connection)
             except RequestError as e:
-                response = {
-                    "type": "response",
-                    "meta": {
-                        "requestId": request["id"],
-                        "error": str(e)
-                    }
-                }
-
-            response_as_string = json.dumps(response)
-            print("> {}".format(response_as_string))
-            await connection.send(response_as_string)
+                error = True
+                response = make_error_response(request, str(e))
+
+            request_type = request["type"] if request["type"] in REQUEST_TYPES else "unknown"
+            metrics.WEBSOCKET_REQUEST_SECONDS.observe(time.perf_counter() - start, (request_type, "true" if error else "false"))
+
+            response_as_bytes = serialization.dumps_bytes(response)
+            response_as_string = response_as_bytes.decode()
+            serialization.log_frame(">", response_as_string)
+            outbox = OUTBOXES.get(connection)
+            if not outbox:
+                # dropped for being too slow
+                break
+            outbox.put(response_as_string, len(response_as_bytes))
 
     except websockets.exceptions.ConnectionClosed:
         print("-1 {} closed connection".format(identifier))
-        ALL_CONNECTIONS.remove(connection)
+    finally:
+        remove_connection(connection, authenticated_user_id)
 
 
-if __name__ == "__main__":
-    if not "__aiter__" in dir(websockets.WebSocketCommonProtocol):
-        print("Python package websockets version >= 4 required.")
-        sys.exit(1)
+def server_options():
+    """Keyword arguments of websockets.serve() for compression and limits"""
+    options = {
+        "max_size": MAX_MESSAGE_SIZE,
+        "max_queue": MAX_QUEUE,
+        "write_limit": WRITE_LIMIT,
+        "compression": None,
+    }
+    if COMPRESSION:
+        options["extensions"] = [MeasuredPerMessageDeflateFactory(
+            server_no_context_takeover=DEFLATE_NO_CONTEXT_TAKEOVER,
+            server_max_window_bits=DEFLATE_WINDOW_BITS,
+            client_max_window_bits=DEFLATE_WINDOW_BITS,
+            compress_settings={"memLevel": DEFLATE_MEM_LEVEL},
+        )]
+    if MSGPACK:
+        options["subprotocols"] = [MSGPACK_SUBPROTOCOL]
+    return options
+
+def serve_forever(args, reuse_port=False):
+    storage.configure(args)
+    async_storage.start(args.storage_read_workers)
 
     print("Starting server at {}:{}".format(HOST, PORT))
-    server = websockets.serve(single_connection_handler, HOST, PORT)
+    server = websockets.serve(single_connection_handler, HOST, PORT,
+                              process_request=process_http_request, reuse_port=reuse_port, **server_options())
 
     EVENT_LOOP.run_until_complete(server)
+    if args.with_rest:
+        import rest #pylint:disable=import-outside-toplevel
+        print("Starting REST server at {}:{}".format(rest.HOST, rest.PORT))
+        EVENT_LOOP.run_until_complete(async_http.serve(rest.MyRequestHandler, rest.HOST, rest.PORT, reuse_port))
+    if STATS_INTERVAL:
+        asyncio.ensure_future(report_send_stats())
     EVENT_LOOP.run_forever()
+
+def run_worker(args, broker):
+    global EVENT_LOOP, EVENT_BUS
+    # nothing of the supervisor's broker is used in the worker
+    broker.sock.close()
+    EVENT_LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(EVENT_LOOP)
+    EVENT_BUS = eventbus.BusClient(broker.path, deliver_published)
+    EVENT_LOOP.create_task(EVENT_BUS.run())
+    # clients are served once their broadcasts reach the other workers
+    EVENT_LOOP.run_until_complete(EVENT_BUS.connected.wait())
+    serve_forever(args, reuse_port=True)
+
+def run_workers(args):
+    """Runs WORKERS server processes accepting connections on the same port
+    (SO_REUSEPORT) and the event bus broker between them"""
+    global EVENT_LOOP
+    bus_path = args.bus_socket or eventbus.default_socket_path(PORT)
+    # bound before the workers start, so that they can connect right away
+    broker = eventbus.Broker(bus_path)
+    broker.bind()
+    # A loop inherited by a worker shares its epoll instance with this
+    # process. When the worker dropped it, closing it would unregister this
+    # process' file descriptors, so every process uses a loop of its own.
+    EVENT_LOOP.close()
+    # forked before this process starts any threads or opens databases
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=run_worker, args=(args, broker), name="websocket-worker-{}".format(index))
+        for index in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+
+    EVENT_LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(EVENT_LOOP)
+    print("Starting event bus at {} for {} workers".format(bus_path, WORKERS))
+    EVENT_LOOP.run_until_complete(broker.start())
+    EVENT_LOOP.add_signal_handler(signal.SIGTERM, EVENT_LOOP.stop)
+    try:
+        EVENT_LOOP.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        os.remove(bus_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kullo chat dummy websocket server")
+    parser.add_argument("--outbox-size", type=int, default=OUTBOX_SIZE,
+                        help="outgoing frames queued per connection before it is dropped")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between send statistics reports (0: off)")
+    parser.add_argument("--storage-read-workers", type=int, default=async_storage.READ_WORKERS,
+                        help="threads reading from storage")
+    parser.add_argument("--with-rest", action="store_true",
+                        help="serve the REST API in this process on the same event loop")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="server processes sharing the port, connected by an event bus")
+    parser.add_argument("--bus-socket", metavar="PATH",
+                        help="Unix socket of the event bus between workers (default: in the temp directory)")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="do not negotiate permessage-deflate")
+    parser.add_argument("--deflate-window-bits", type=int, choices=range(9, 16), default=DEFLATE_WINDOW_BITS,
+                        metavar="9-15", help="permessage-deflate window size of both sides")
+    parser.add_argument("--deflate-mem-level", type=int, choices=range(1, 10), default=DEFLATE_MEM_LEVEL,
+                        metavar="1-9", help="zlib memory level of the server's compressor")
+    parser.add_argument("--deflate-no-context-takeover", action="store_true",
+                        help="compress every message on its own, saving memory between messages")
+    parser.add_argument("--max-message-size", type=int, default=MAX_MESSAGE_SIZE,
+                        help="largest incoming message in bytes")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE,
+                        help="incoming messages buffered per connection")
+    parser.add_argument("--write-limit", type=int, default=WRITE_LIMIT,
+                        help="bytes buffered per connection before sending waits")
+    parser.add_argument("--msgpack", action="store_true",
+                        help="offer the {} subprotocol for binary message.added events".format(MSGPACK_SUBPROTOCOL))
+    async_http.add_arguments(parser)
+    serialization.add_arguments(parser)
+    storage.add_arguments(parser)
+    args = parser.parse_args()
+    if args.msgpack and serialization.msgpack is None:
+        parser.error("--msgpack requires the Python package msgpack")
+    async_http.configure(args)
+    serialization.configure(args)
+    OUTBOX_SIZE = args.outbox_size
+    STATS_INTERVAL = args.stats_interval
+    WORKERS = args.workers
+    COMPRESSION = not args.no_compression
+    DEFLATE_WINDOW_BITS = args.deflate_window_bits
+    DEFLATE_MEM_LEVEL = args.deflate_mem_level
+    DEFLATE_NO_CONTEXT_TAKEOVER = args.deflate_no_context_takeover
+    MAX_MESSAGE_SIZE = args.max_message_size
+    MAX_QUEUE = args.max_queue
+    WRITE_LIMIT = args.write_limit
+    MSGPACK = args.msgpack
+
+    if WORKERS > 1:
+        run_workers(args)
+    else:
+        serve_forever(args)
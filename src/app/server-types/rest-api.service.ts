@@ -92,13 +92,21 @@ export class RestApiService implements RestApiServiceInterface {
 
   async getConversations(): Promise<ConversationsWithPermissions> {
     let authorization = await this.makeAuthorization();
-    let body: any = await this.http
-      .get(Config.API_BASE_URL + '/conversations', {
-        headers: { 'Authorization': authorization },
-      })
-      .toPromise();
-    let conversations: ServerConversation[] = body["objects"].map((object: any) => ServerConversation.fromJson(object));
-    let permissions: ServerPermission[] = body["related"]["permissions"].map((object: any) => ServerPermission.fromJson(object));
+    let conversations = new Array<ServerConversation>();
+    let permissions = new Array<ServerPermission>();
+    let nextCursor: string | null = null;
+    do {
+      let params = nextCursor ? { "cursor": nextCursor } : {};
+      let body: any = await this.http
+        .get(Config.API_BASE_URL + '/conversations', {
+          headers: { 'Authorization': authorization },
+          params: params
+        })
+        .toPromise();
+      nextCursor = body["meta"]["nextCursor"];
+      conversations.push(...body["objects"].map((object: any) => ServerConversation.fromJson(object)));
+      permissions.push(...body["related"]["permissions"].map((object: any) => ServerPermission.fromJson(object)));
+    } while (nextCursor);
     console.log("Got conversations via REST:", conversations, permissions);
     return {
       conversations: conversations,
@@ -182,14 +190,22 @@ export class RestApiService implements RestApiServiceInterface {
   }
 
   async getUsers(state?: string): Promise<User[]> {
-    let url = (state) ? '/users?state=' + state : '/users';
     let authorization = await this.makeAuthorization();
-    let body: any = await this.http
-      .get(Config.API_BASE_URL + url, {
-        headers: { 'Authorization': authorization },
-      })
-      .toPromise();
-    let users: User[] = body["objects"].map((object: any) => User.fromJson(object));
+    let users = new Array<User>();
+    let nextCursor: string | null = null;
+    do {
+      let params: { [param: string]: string } = {};
+      if (state) params["state"] = state;
+      if (nextCursor) params["cursor"] = nextCursor;
+      let body: any = await this.http
+        .get(Config.API_BASE_URL + '/users', {
+          headers: { 'Authorization': authorization },
+          params: params
+        })
+        .toPromise();
+      nextCursor = body["meta"]["nextCursor"];
+      users.push(...body["objects"].map((object: any) => User.fromJson(object)));
+    } while (nextCursor);
     console.log("Got users via REST:", users);
     return users;
   }